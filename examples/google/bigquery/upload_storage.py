@@ -44,10 +44,12 @@ for image_file in dicom_files:
         metadata[image_file] = updates
 
 
-# Upload the dataset
-client.upload_dataset(items=dicom_files,
-                       table=table,
-                       mimetype="application/dicom",
-                       entity_key="entity_id",
-                       item_key="item_id",
-                       metadata=metadata)
+# Upload the dataset, the rows that were not inserted are returned
+errors = client.upload_dataset(items=dicom_files,
+                               table=table,
+                               mimetype="application/dicom",
+                               entity_key="entity_id",
+                               item_key="item_id",
+                               metadata=metadata)
+if errors:
+    print("%s rows were not inserted." %len(errors))
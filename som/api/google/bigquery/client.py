@@ -29,11 +29,22 @@ SOFTWARE.
 
 from .models import BigQueryManager
 from som.api.google.storage.client import StorageClientBase
-from som.api.google.storage.utils import get_storage_fields
+from som.api.google.storage.utils import (
+    delete_object,
+    get_storage_fields
+)
+from som.api.google.utils import get_cloud_client
 from google.cloud import storage
 from .utils import *
 from .schema import dicom_schema
 from som.logger import bot
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    as_completed,
+    wait
+)
+import tempfile
 import six
 
 
@@ -44,13 +55,23 @@ class BigQueryClient(StorageClientBase):
         that handles calls from the user.
     '''
 
-    def __init__(self, project, bucket_name, schema=None, **kwargs):
+    def __init__(self, project, bucket_name, schema=None, cache_ttl=300, row_key=None,
+                 flush_size=None, **kwargs):
         super(BigQueryClient, self).__init__(project, bucket_name, **kwargs)
-        self.bigquery = bigquery.Client(self.project)
+        self.bigquery = get_cloud_client('bigquery', self.project)
         self.name = "bigquery"
-        self.batch = BigQueryManager(client=self.bigquery)
+
+        # If row_key (eg, "storage_name"), insert ids are derived from it,
+        # and added rows are inserted every flush_size rows
+        self.batch = BigQueryManager(client=self.bigquery,
+                                     row_key=row_key,
+                                     flush_size=flush_size)
+        self.upload_errors = []
         self.set_schema(schema)
 
+        # Dataset and table handles are kept for cache_ttl seconds
+        self.handles = HandleCache(ttl=cache_ttl)
+
     def set_schema(self, schema):
         if schema is None:
             schema = dicom_schema
@@ -65,7 +86,8 @@ class BigQueryClient(StorageClientBase):
         '''
         return get_dataset(project=self.project,
                            client=self.bigquery,
-                           name=name)
+                           name=name,
+                           cache=self.handles)
 
 
     def get_or_create_dataset(self, name):
@@ -74,7 +96,8 @@ class BigQueryClient(StorageClientBase):
         '''
         return create_dataset(project=self.project,
                               client=self.bigquery,
-                              name=name)
+                              name=name,
+                              cache=self.handles)
 
 
     def get_table(self, table_name, dataset):
@@ -84,12 +107,16 @@ class BigQueryClient(StorageClientBase):
         return get_table(project=self.project,
                          client=self.bigquery,
                          table_name=table_name,
-                         dataset=dataset)
+                         dataset=dataset,
+                         cache=self.handles)
 
 
-    def get_or_create_table(self, dataset, table_name, quiet=False, schema=None):
+    def get_or_create_table(self, dataset, table_name, quiet=False, schema=None,
+                            partition=None, partition_field=None, clustering_fields=None,
+                            partition_expiration=None):
         '''get a new table with "name" (required), creates if doesn't
-           exist
+           exist. A new table can be partitioned (eg, partition="DAY") by
+           ingestion time or a partition_field, see utils.create_table
         '''
         if schema is None:
             schema = self.schema
@@ -98,13 +125,60 @@ class BigQueryClient(StorageClientBase):
                             schema=schema,
                             quiet=quiet,
                             dataset=dataset,
-                            table_name=table_name)
+                            table_name=table_name,
+                            cache=self.handles,
+                            partition=partition,
+                            partition_field=partition_field,
+                            clustering_fields=clustering_fields,
+                            partition_expiration=partition_expiration)
  
 
     ###################################################################
     ## Get ############################################################
     ###################################################################
 
+    def dry_run(self, sql, legacy_sql=False, quiet=False):
+        '''return the bytes a query would scan (a dry run is free), to check
+           that partitions are used before running it
+        '''
+        return dry_run_query(sql=sql,
+                             client=self.bigquery,
+                             legacy_sql=legacy_sql,
+                             quiet=quiet)
+
+
+    def query(self, sql, output=None, page_size=None, prefetch=None,
+              legacy_sql=False, timeout=None):
+        '''query will run sql (standard, unless legacy_sql) and stream the 
+        results, page by page, with the next pages fetched in the background.
+        Memory is bounded by a few pages, not the number of rows.
+        :param output: None (default) to return a generator of rows (dicts), 
+                       "pages" for a generator of (names, rows) pages, or 
+                       "numpy" (a dict of arrays) or "arrow" (a pyarrow Table) 
+                       to build columns directly, without a dict per row.
+        :param page_size: the rows per page (default QUERY_PAGE_SIZE)
+        :param prefetch: the pages to fetch ahead (default QUERY_PREFETCH)
+        Returns None if the query fails.
+        '''
+        results = run_query(sql=sql,
+                            client=self.bigquery,
+                            legacy_sql=legacy_sql,
+                            timeout=timeout)
+        if results is None:
+            return None
+
+        pages = iter_result_pages(results,
+                                  page_size=page_size,
+                                  prefetch=prefetch)
+        if output is None:
+            return iter_result_rows(pages)
+        if output == "pages":
+            return pages
+        return get_result_columns(pages,
+                                  output=output,
+                                  results=results)
+
+
     def get_storage_path(self,file_path, 
                               entity_name,
                               study_name):
@@ -173,7 +247,10 @@ class BigQueryClient(StorageClientBase):
                        entity_key="entity_id",
                        permission="projectPrivate",
                        metadata={},
-                       batch=True):
+                       batch=True,
+                       mode="stream",
+                       source_format="json",
+                       workers=None):
 
         '''upload datasets will upload a number of items (a list of images) to 
         Google Storag, and if metadata is provided upload metadata to Google
@@ -188,29 +265,180 @@ class BigQueryClient(StorageClientBase):
                            / Collection / <study> / Entity / <entity_id> / file_paths
 
         :param batch: add entities in batches (recommended, default True)
+        :param mode: "stream" to add rows with streaming inserts (default), or
+                     "load" to write the rows to a file, and load it with a
+                     load job (recommended for large backfills), see load_rows
+        :param source_format: the file format for load mode, json or avro
+        :param workers: if greater than 1, upload items to storage with a pool
+                        of this many threads, and add rows as uploads finish
+
+        Items that are skipped, or have an error uploading, are saved in
+        upload_errors as {"item", "error"}.
+
+        Returns the load job in load mode. In stream mode (this used to
+        return the table) a list of the rows that were not inserted is
+        returned, {"index", "errors", "row"} with index the number of the
+        row in this upload, from every insert (including the flushes as
+        rows are added), see BigQueryManager.get_insert_errors. It is None
+        if batch is False, and the rows are left to insert with runInsert.
+        '''
+        self.upload_errors = []
+        rows = self.iter_rows(items=items,
+                              study_name=study_name,
+                              mimetype=mimetype,
+                              entity_key=entity_key,
+                              permission=permission,
+                              metadata=metadata,
+                              workers=workers)
+
+        if mode == "load":
+            result = self.load_rows(rows=rows,
+                                    table=table,
+                                    source_format=source_format)
+        else:
+            # Rows are added (and flushed, see flush_size) as uploads finish
+            first_row = self.batch.rows_added
+            buffered = []
+            for rowdict in rows:
+                buffered.append(rowdict)
+                if len(buffered) >= self.batch.chunk_size:
+                    self.batch.add_rows(table=table, rows=buffered)
+                    buffered = []
+            if buffered:
+                self.batch.add_rows(table=table, rows=buffered)
+
+            # Run batch insert of data to BigQuery
+            result = None
+            if batch is True:
+                self.batch.runInsert(table)
+                result = self.batch.get_insert_errors(start=first_row)
+
+        if self.upload_errors:
+            bot.warning("%s items had errors, see upload_errors." %len(self.upload_errors))
+        return result
+
+
+    def iter_rows(self, items, study_name, mimetype, entity_key="entity_id",
+                  permission="projectPrivate", metadata={}, workers=None):
+        '''iter_rows will upload each item (with metadata) to storage, and 
+        yield its row (the metadata, updated with storage fields). If workers
+        is greater than 1, uploads run on a pool of that many threads, and 
+        rows are yielded as they finish (not in order of items). See 
+        upload_dataset for parameters.
+        '''
+        uploads = self._iter_uploads(items, metadata, entity_key)
+        kwargs = {'study_name': study_name,
+                  'mimetype': mimetype,
+                  'permission': permission}
+
+        if workers is None or workers <= 1:
+            for item,rowdict,entity_id in uploads:
+                yield self._upload_row(item, rowdict, entity_id, **kwargs)
+            return
+
+        # At most two uploads per worker are queued, to keep memory flat
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = set()
+            for upload in uploads:
+                pending.add(executor.submit(self._upload_row, *upload, **kwargs))
+                if len(pending) >= workers * 2:
+                    done,pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+            for future in as_completed(pending):
+                yield future.result()
+
+
+    def _iter_uploads(self, items, metadata, entity_key):
+        '''yield (item, rowdict, entity_id) for items that have metadata with
+        an entity_key, and save an upload error for the others.
         '''
-       
         for item in items:
-            if item in metadata:
-                rowdict = metadata.get(item,{})
-                # Entity and item keys must be provided for Storage path
-                if entity_key in rowdict:
-                    entity_id = rowdict[entity_key]
-
-                    # Get back storage fields
-                    fields = self.upload_item(file_path=item,
-                                              entity_id=entity_id,
-                                              study_name=study_name,
-                                              mimetype=mimetype,
-                                              permission=permission)
-
-                    if fields is not None:
-                        rowdict.update(fields)
-                    self.batch.add_rows(table=table, rows=[rowdict])
-
-                else:
-                    bot.warning("Skipping upload of %s, cannot determine storage path." %item)
-
-        # Run batch insert of data to BigQuery
-        if batch is True:
-            return self.batch.runInsert(table)
+            if item not in metadata:
+                self._add_upload_error(item, "no metadata for item, skipping upload.")
+                continue
+            rowdict = metadata.get(item,{})
+            # Entity and item keys must be provided for Storage path
+            if entity_key not in rowdict:
+                self._add_upload_error(item, "cannot determine storage path, skipping upload.")
+                continue
+            yield item, rowdict, rowdict[entity_key]
+
+
+    def _upload_row(self, item, rowdict, entity_id, study_name, mimetype, permission):
+        '''upload an item to storage, and return its rowdict updated with
+        the storage fields. If the upload fails, the error is saved, and the
+        rowdict is returned without storage fields.
+        '''
+        try:
+            fields = self.upload_item(file_path=item,
+                                      entity_id=entity_id,
+                                      study_name=study_name,
+                                      mimetype=mimetype,
+                                      permission=permission)
+        except Exception as error:
+            self._add_upload_error(item, str(error))
+            return rowdict
+
+        if fields is None:
+            self._add_upload_error(item, "error uploading to storage.")
+        else:
+            rowdict.update(fields)
+        return rowdict
+
+
+    def _add_upload_error(self, item, message):
+        bot.warning("%s: %s" %(item, message))
+        self.upload_errors.append({'item': item, 'error': message})
+
+
+    def load_rows(self, rows, table, source_format="json", bucket_folder="bigquery-loads",
+                  poll_interval=5, timeout=None):
+        '''load_rows will write rows (dicts, as for add_rows) to a temporary
+        file one at a time, upload it to storage (in bucket_folder), and load
+        it into the table with a load job. Load jobs are free and much faster
+        than streaming inserts for many rows. The local file is removed, and
+        the file in storage once the job is done. Returns the job, or None if
+        there are no rows.
+        :param source_format: json (newline delimited) or avro (needs fastavro)
+        '''
+        schema = table.schema
+        rows = (row for rowdict in rows
+                    for row in self.batch._dict_to_rows(rowdict, schema))
+
+        fd,file_path = tempfile.mkstemp(prefix="som-load-", suffix=".%s" %source_format)
+        os.close(fd)
+        job = None
+        try:
+            count = write_rows(rows=rows,
+                               file_name=file_path,
+                               schema=schema,
+                               source_format=source_format)
+            if count == 0:
+                bot.warning("There are no rows to load.")
+                return job
+
+            mimetype = "application/json"
+            if source_format == "avro":
+                mimetype = "application/octet-stream"
+            storage_obj = self.put_object(file_path=file_path,
+                                          bucket_folder=bucket_folder,
+                                          permission="projectPrivate",
+                                          mimetype=mimetype)
+            if storage_obj is None:
+                bot.error("Error uploading %s rows to storage for load job." %count)
+                return job
+
+            source_uri = "gs://%s/%s" %(self.bucket['name'], storage_obj['name'])
+            job = run_load_job(table=table,
+                               source_uris=[source_uri],
+                               source_format=source_format,
+                               client=self.bigquery,
+                               poll_interval=poll_interval,
+                               timeout=timeout)
+            # If the job is still running (timeout) it still needs the file
+            if job.state == 'DONE':
+                delete_object(self.get_storage(), self.bucket['name'], storage_obj['name'])
+        finally:
+            os.remove(file_path)
+        return job
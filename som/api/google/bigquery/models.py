@@ -25,17 +25,41 @@ SOFTWARE.
  
 from google.cloud import bigquery
 from som.api.google.models import BatchManager, ModelBase
+from som.api.google.utils import get_cloud_client
+from .utils import (
+    RowEncoder,
+    get_schema_key
+)
 from retrying import retry
 from google.cloud.exceptions import (
     BadRequest,
+    GoogleCloudError,
     GrpcRendezvous
 )
 from som.logger import bot
 import datetime
+import hashlib
+import json
+import six
 import sys
+import time
 import os
 
 
+# A streaming insert should have at most 500 rows (recommended) and
+# 10MB per request, we leave room for the request itself
+BIGQUERY_MAX_ROWS = 500
+BIGQUERY_MAX_BYTES = 9 * 1024 * 1024
+
+# By default, add_rows inserts the buffer when it has this many chunks
+BIGQUERY_FLUSH_CHUNKS = 4
+
+# Rows that failed with these reasons can be sent again. A row is
+# "stopped" when another row in the same request was invalid
+BIGQUERY_RETRY_REASONS = ['backendError', 'internalError', 'rateLimitExceeded',
+                          'stopped', 'timeout']
+
+
 class BigQueryManager(BatchManager):
     '''a batch manager that sends metadata to Google BigQuery, is a child
        class of som.google.api.models BatchManager that has skeleton functions
@@ -49,38 +73,262 @@ class BigQueryManager(BatchManager):
        ==========
        rows: a list of rows to add to some table, to be specified when the 
        manager is initialized.
+       chunk_size: the most rows to send in one insert (default and
+                   at most BIGQUERY_MAX_ROWS)
+       max_bytes: the most (json) bytes of rows in one insert (default
+                  and at most BIGQUERY_MAX_BYTES)
+       flush_size: the most rows to buffer, when add_rows reaches this
+                   many new rows they are inserted (default 
+                   BIGQUERY_FLUSH_CHUNKS * chunk_size)
+       retries: the number of times to send rows that failed again, if
+                the failure is not permanent (see BIGQUERY_RETRY_REASONS)
+       row_key: a field name (eg, "storage_name" or "SOPInstanceUID"), list
+                of names, or function of a row (dict), to derive the insert 
+                id of each row from. Rows with the same id inserted again
+                (eg, by a retry) are dropped by BigQuery (best effort).
 
     '''
-    def __init__(self, **kwargs):
+    def __init__(self, chunk_size=None, max_bytes=None, flush_size=None,
+                 retries=3, row_key=None, **kwargs):
         super(BigQueryManager, self).__init__(**kwargs)
         if self.client is None:
-            self.client = bigquery.Client()
+            self.client = get_cloud_client('bigquery')
+        if chunk_size is None or chunk_size > BIGQUERY_MAX_ROWS:
+            chunk_size = BIGQUERY_MAX_ROWS
+        if max_bytes is None or max_bytes > BIGQUERY_MAX_BYTES:
+            max_bytes = BIGQUERY_MAX_BYTES
+        if flush_size is None:
+            flush_size = BIGQUERY_FLUSH_CHUNKS * chunk_size
+        self.chunk_size = chunk_size
+        self.max_bytes = max_bytes
+        self.flush_size = flush_size
+        self.retries = retries
         self.rows = []
+        self.row_sizes = []
+        self.row_ids = []
         self.table = None
 
+        # Rows left in the buffer by the last runInsert (they failed), that
+        # don't count toward flush_size, so they aren't sent on every add
+        self.retained_rows = 0
+
+        # Each row is numbered in the order it was added, and the error for
+        # each row not inserted (by any runInsert, including flushes) is
+        # kept by number, until the row is inserted
+        self.row_numbers = []
+        self.rows_added = 0
+        self.insert_errors = dict()
+
+        # Insert ids are derived from these field(s), or a function of the row
+        if isinstance(row_key, six.string_types):
+            row_key = [row_key]
+        self.row_key = row_key
+
+        # Row encoders, compiled once for each schema
+        self.encoders = dict()
+
+        # (rows, bytes, seconds) for each insert request, for throughput
+        self.insert_times = []
+
     def set_table(self,table, clear_rows=True):
         self.table = table
         if clear_rows is True:
             bot.debug("Clearing previously added rows. Set clear_rows to False to prevent this.")
             self.rows = []
+            self.row_sizes = []
+            self.row_ids = []
+            self.row_numbers = []
+            self.retained_rows = 0
         return self.rows 
 
 
-    def runInsert(self, table=None):
+    def get_row_id(self, rowdict):
+        '''get_row_id returns the insert id for a row (a dict), derived from
+        the values of the row_key fields, so the same row always has the 
+        same id. If the row is missing a row_key field, the id is derived
+        from all of its values. Without a row_key, the id is None.
+        '''
+        if self.row_key is None:
+            return None
+        if callable(self.row_key):
+            return get_insert_id(self.row_key(rowdict))
+        if any(key not in rowdict for key in self.row_key):
+            bot.debug("Row is missing a row_key field, using all values for the insert id.")
+            return get_insert_id(sorted(rowdict.items()))
+        return get_insert_id([rowdict[key] for key in self.row_key])
+
+
+    def runInsert(self, table=None, clear_rows=True):
+        '''runInsert will insert the buffered rows into the table, in chunks
+        of at most chunk_size rows and max_bytes. Rows that fail are sent
+        again on their own (up to retries times) if the error is not
+        permanent. Rows that still fail (and aren't invalid) stay in the
+        buffer (when clear_rows is True) to be sent with the next runInsert.
+        The errors for the rows not inserted are returned, a list of
+        {"index", "errors", "row"}, with index the number of the row in the
+        order rows were added (see get_insert_errors).
+        '''
+        if table is None:
+            table = self.table
+
+        errors = []
         if len(self.rows) > 0:
-            table = table.insert_data(self.rows)
-            self.rows = []
-        return table
+            failed = []
+            for start,end in self._chunk_rows(self.row_sizes):
+                chunk_errors = dict(self._insert_rows(table,
+                                                      self.rows[start:end],
+                                                      self.row_sizes[start:end],
+                                                      self.row_ids[start:end]))
+                for index in range(end - start):
+                    number = self.row_numbers[start + index]
+                    if index not in chunk_errors:
+                        self.insert_errors.pop(number, None)
+                        continue
+                    error = dict(chunk_errors[index], index=number)
+                    if is_retryable(error):
+                        failed.append(start + index)
+                    self.insert_errors[number] = error
+                    errors.append(error)
+
+            if errors:
+                bot.warning("%s of %s rows were not inserted." %(len(errors),
+                                                                 len(self.rows)))
+            bot.debug("Inserted rows: %s" %self.get_throughput())
+            if clear_rows:
+                self.rows = [self.rows[i] for i in failed]
+                self.row_sizes = [self.row_sizes[i] for i in failed]
+                self.row_ids = [self.row_ids[i] for i in failed]
+                self.row_numbers = [self.row_numbers[i] for i in failed]
+            self.retained_rows = len(self.rows)
+        return errors
+
+
+    def get_insert_errors(self, start=0):
+        '''return the errors for rows that were not inserted (by any
+        runInsert, including the flushes from add_rows), a list of
+        {"index", "errors", "row"} in the order the rows were added. Only
+        rows numbered from start (eg, rows_added before an upload) are
+        included, and index is counted from start.
+        '''
+        return [dict(self.insert_errors[number], index=number - start)
+                for number in sorted(self.insert_errors) if number >= start]
+
+
+    def _chunk_rows(self, sizes):
+        '''yield (start, end) of chunks of at most chunk_size rows, and 
+        max_bytes, for one insert request each.
+        '''
+        start = 0
+        while start < len(sizes):
+            end = start
+            nbytes = 0
+            while end < len(sizes) and end - start < self.chunk_size:
+                if end > start and nbytes + sizes[end] > self.max_bytes:
+                    break
+                nbytes += sizes[end]
+                end += 1
+            yield start, end
+            start = end
+
+
+    def _insert_rows(self, table, rows, sizes, row_ids):
+        '''insert one chunk of rows, and send failed rows again (only those,
+        with the same insert ids) if the failure isn't permanent. Returns a
+        list of (index, error) for the rows that were not inserted, index 
+        in rows.
+        '''
+        pending = list(range(len(rows)))
+        failed = []
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                bot.debug("Retrying %s failed rows." %len(pending))
+                time.sleep(2 ** attempt)
+
+            started = time.time()
+            try:
+                insert_errors = self._insert_chunk(table,
+                                                   [rows[i] for i in pending],
+                                                   [row_ids[i] for i in pending])
+            except (BadRequest, GoogleCloudError) as error:
+                bot.error("Error inserting %s rows: %s" %(len(pending), error))
+                insert_errors = [{'index': i, 'errors': [{'reason': 'invalid',
+                                                          'message': str(error)}]}
+                                 for i in range(len(pending))]
+            self.insert_times.append((len(pending) - len(insert_errors),
+                                      sum(sizes[i] for i in pending),
+                                      time.time() - started))
+
+            retry_rows = []
+            for error in insert_errors:
+                index = pending[error['index']]
+                if attempt < self.retries and is_retryable(error):
+                    retry_rows.append(index)
+                else:
+                    failed.append((index, dict(error, row=rows[index])))
+            pending = retry_rows
+            if not pending:
+                break
+
+        return failed
+
+
+    @retry(retry_on_exception=lambda error: not isinstance(error, BadRequest),
+           wait_exponential_multiplier=1000,wait_exponential_max=10000,stop_max_attempt_number=5)
+    def _insert_chunk(self, table, rows, row_ids=None):
+        '''insert a single chunk of rows (no larger than a request allows),
+        returning the per row errors. A bad request is not retried. The
+        insert ids are the same for every try, so BigQuery can drop rows
+        that were already inserted by a try that seemed to fail.
+        '''
+        if row_ids is not None and all(x is None for x in row_ids):
+            row_ids = None
+        return table.insert_data(rows, row_ids=row_ids)
+
+
+    def get_throughput(self):
+        '''return a summary of the rows and bytes per second inserted by
+        runInsert (the time spent in insert requests).
+        '''
+        rows = sum(x[0] for x in self.insert_times)
+        nbytes = sum(x[1] for x in self.insert_times)
+        seconds = sum(x[2] for x in self.insert_times)
+        if seconds <= 0:
+            return "%s rows" %rows
+        return "%s rows, %.1f rows/s, %.2f MB/s" %(rows, rows / seconds,
+                                                   nbytes / seconds / (1024 * 1024))
        
 
     def add_rows(self, rows, table=None):
          ''' Add one or more rows to a table. Rows should be a list of
-             dict, each item corresponding to a key/value
+             dict, each item corresponding to a key/value. A row that isn't
+             a dict is not added, and is an insert error (see 
+             get_insert_errors). If the buffer reaches flush_size new rows,
+             the rows are inserted.
          '''
          table = self._validate_table(table)
-         if table is not None:
+         if table:
+             if not isinstance(rows, list):
+                 rows = [rows]
+             valid = []
+             for rowdict in rows:
+                 if isinstance(rowdict, dict):
+                     valid.append(rowdict)
+                     self.row_numbers.append(self.rows_added)
+                 else:
+                     bot.warning("Row %s is not a dict, skipping: %r" %(self.rows_added, rowdict))
+                     self.insert_errors[self.rows_added] = {'index': self.rows_added,
+                                                            'errors': [{'reason': 'invalid',
+                                                                        'message': 'row is not a dict'}],
+                                                            'row': rowdict}
+                 self.rows_added += 1
+             rows = valid
+             self.row_ids.extend(self.get_row_id(rowdict) for rowdict in rows)
              rows = self._dict_to_rows(rows, table.schema)
-             self.rows = self.rows + rows
+             self.rows.extend(rows)
+             self.row_sizes.extend(get_row_size(row) for row in rows)
+             if len(self.rows) - self.retained_rows >= self.flush_size:
+                 bot.debug("Buffer reached %s rows, flushing." %len(self.rows))
+                 self.runInsert(table)
 
 
     def _validate_table(self, table, schema_required=True):
@@ -114,7 +362,7 @@ class BigQueryManager(BatchManager):
 
         # The table must have a schema
         if schema_required is True:
-            if table.schema in ["",[]]: 
+            if active_table.schema in ["",[]]: 
                 bot.error("Table must be defined with a schema before batch insert.") 
                 active_table = None
 
@@ -125,20 +373,42 @@ class BigQueryManager(BatchManager):
         ''' check a list of rows, each a dict of field names
             (keys) and values, against a schema. Only fields present in the
             schema are returned, and missing fields are returned empty.
+            Values are converted for their field (see RowEncoder).
         '''
-        schema_fields = [x.name for x in schema]
-
-        valid_rows = []
         if not isinstance(rows, list):
             rows = [rows]       
-        for rowdict in rows:
-            if isinstance(rowdict, dict):
-                new_row = [ rowdict[key] if key in rowdict else None for key in schema_fields]
-                if len(new_row) > 0:
-                    unlisted = []
-                    for item in new_row:
-                        if isinstance(item,list):
-                            item=','.join([str(x) for x in item])
-                        unlisted.append(item)
-                    valid_rows.append(unlisted)
-        return valid_rows
+        return self.get_encoder(schema).encode_rows(rows)
+
+
+    def get_encoder(self, schema):
+        '''return the RowEncoder for a schema, compiled once and cached'''
+        key = get_schema_key(schema)
+        encoder = self.encoders.get(key)
+        if encoder is None:
+            encoder = RowEncoder(schema)
+            self.encoders[key] = encoder
+        return encoder
+
+
+
+def get_row_size(row):
+    '''return the approximate size (in bytes) of a row, as sent in json'''
+    return len(json.dumps(row, default=str)) + 1
+
+
+
+def is_retryable(error):
+    '''return True if an insert error (for one row) can be sent again,
+    meaning all of its reasons are in BIGQUERY_RETRY_REASONS.
+    '''
+    reasons = [x.get('reason') for x in error.get('errors', [])]
+    return len(reasons) > 0 and all(x in BIGQUERY_RETRY_REASONS for x in reasons)
+
+
+
+def get_insert_id(values):
+    '''return a deterministic insert id (a sha1 hex digest) for values'''
+    if not isinstance(values, (list, tuple)):
+        values = [values]
+    key = json.dumps(list(values), default=str, sort_keys=True)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
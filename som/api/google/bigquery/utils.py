@@ -26,18 +26,61 @@ https://googlecloudplatform.github.io/google-cloud-python/latest/bigquery/usage.
 '''
 
 from google.cloud import bigquery
+from google.cloud.exceptions import BadRequest
+from som.api.google.utils import get_cloud_client
 from som.logger import bot
+import datetime
+from six.moves import queue
+import json
+import re
+import six
 import sys
+import threading
+import time
+import uuid
 import os
 
-# Read in test dataset
+
+# Load jobs read rows from files in one of these formats
+LOAD_FORMATS = {'json': 'NEWLINE_DELIMITED_JSON',
+                'avro': 'AVRO'}
+
+# BigQuery types as Avro types, others are written as strings
+AVRO_TYPES = {'STRING': 'string',
+              'BYTES': 'bytes',
+              'INTEGER': 'long',
+              'INT64': 'long',
+              'FLOAT': 'double',
+              'FLOAT64': 'double',
+              'BOOLEAN': 'boolean',
+              'BOOL': 'boolean',
+              'TIMESTAMP': {'type': 'long', 'logicalType': 'timestamp-micros'},
+              'DATE': {'type': 'int', 'logicalType': 'date'}}
+
+# Query results are converted to pyarrow types of these names, and
+# types not here are strings
+ARROW_TYPES = {'STRING': 'string',
+               'BYTES': 'binary',
+               'INTEGER': 'int64',
+               'INT64': 'int64',
+               'FLOAT': 'float64',
+               'FLOAT64': 'float64',
+               'BOOLEAN': 'bool_',
+               'BOOL': 'bool_',
+               'DATE': 'date32'}
+
+# Tables can be partitioned by a field of these types, and (with this
+# google-cloud-bigquery) only by day
+PARTITION_TYPES = ['TIMESTAMP', 'DATE']
+PARTITION_UNITS = ['DAY']
+
 
 def get_client(project=None, client=None):
-    ''' return a new client if not provided, with project specified,
+    ''' return a (shared) client if not provided, with project specified,
         or None to use the active project
     '''
     if client is None:
-        client = bigquery.Client(project=project)
+        client = get_cloud_client('bigquery', project)
     return client
 
 
@@ -50,13 +93,23 @@ def list_datasets(project=None, client=None):
         print(dataset.name)
 
 
-def get_dataset(name, project=None, client=None):
-    ''' get a dataset. If doesn't exist, returns None
+def get_dataset(name, project=None, client=None, cache=None):
+    ''' get a dataset. If doesn't exist, returns None. If a cache
+        (HandleCache) is provided, a cached dataset is returned without
+        checking that it exists.
     '''
     client = get_client(project, client)
+    key = ('dataset', client.project, name)
+    if cache is not None:
+        dataset = cache.get(key)
+        if dataset is not None:
+            return dataset
+
     dataset = client.dataset(name)
     if not dataset.exists():
-        dataset = None
+        return None
+    if cache is not None:
+        cache.set(key, dataset)
     return dataset
 
 
@@ -68,16 +121,30 @@ def create_schema(schema):
     bqschema = []
 
     for field,field_type in schema.items():
-        entry =     bigquery.SchemaField(field, field_type.upper()),
+        entry = bigquery.SchemaField(field, field_type.upper())
         bqschema.append(entry)
     return tuple(bqschema)
 
 
-def create_table(dataset, table_name, project=None, schema=None, client=None, quiet=False):
-    '''create a table for a specified dataset and project
+def create_table(dataset, table_name, project=None, schema=None, client=None, quiet=False,
+                 cache=None, partition=None, partition_field=None, clustering_fields=None,
+                 partition_expiration=None):
+    '''create a table for a specified dataset and project. If the table
+       exists, the schema is only updated if it differs (see get_schema_diff).
+       If a cache (HandleCache) is provided, a cached table with the same
+       schema is returned without any calls to BigQuery.
+
+       Partitioning can only be set when the table is created:
+
+       partition: the partition type (eg, "DAY") or None for no partitions.
+                  Partitions are by ingestion time, unless partition_field
+                  is a TIMESTAMP or DATE field in the schema.
+       clustering_fields: not supported by this google-cloud-bigquery,
+                          giving them is an error
+       partition_expiration: if defined, partitions are deleted after this
+                             many milliseconds
     '''
     client = get_client(project, client)
-    table = dataset.table(table_name)
 
     if schema is None:
         bot.debug("Creating table with default dicom schema")
@@ -88,35 +155,83 @@ def create_table(dataset, table_name, project=None, schema=None, client=None, qu
     elif isinstance(schema, dict):
         schema = create_schema(schema)
 
-    table.schema = schema
-    
+    if not validate_partitioning(schema, partition, partition_field, clustering_fields):
+        return None
+
+    key = ('table', client.project, dataset.name, table_name)
+    if cache is not None:
+        table = cache.get(key)
+        if table is not None and not has_schema_changes(get_schema_diff(table.schema, schema)):
+            return table
+
+    table = dataset.table(table_name)
     if not table.exists():
+        table.schema = schema
+        set_partitioning(table,
+                         partition=partition,
+                         partition_field=partition_field,
+                         partition_expiration=partition_expiration)
         table.create()
         message = 'Created table {} in dataset {}.'.format(table_name, dataset.name)
     else:
-        table.update()
+        table.reload()
+        if partition is not None:
+            bot.debug("Table %s exists, partitioning is not changed." %table_name)
+        diff = get_schema_diff(table.schema, schema)
         message = 'Table {} in dataset {} already exists.'.format(table_name, dataset.name)
+        if has_schema_changes(diff):
+            table.schema = merge_schema(table.schema, schema)
+            table.update()
+            message = 'Updated schema of table {} in dataset {}, {} fields added.'.format(table_name,
+                                                                                       dataset.name,
+                                                                                       len(diff['added']))
+        if diff['changed']:
+            bot.warning("Fields %s have a different type or mode in table %s. BigQuery can't change them, the table's are kept." %(', '.join(diff['changed']),
+                                                                                                                                 table_name))
+        if diff['removed']:
+            bot.warning("Fields %s are in table %s, but not the schema. They are kept." %(', '.join(diff['removed']),
+                                                                                         table_name))
 
     if not quiet:
         bot.info(message)
 
+    if cache is not None:
+        cache.set(key, table)
     return table
 
 
-def get_table(dataset, table_name, project=None, client=None):
-    '''create a table for a specified dataset and project
+def get_table(dataset, table_name, project=None, client=None, cache=None):
+    '''get a table for a specified dataset and project, or None if it
+       doesn't exist. If a cache (HandleCache) is provided, a cached table
+       is returned without checking that it exists.
     '''
     client = get_client(project, client)
+    key = ('table', client.project, dataset.name, table_name)
+    if cache is not None:
+        table = cache.get(key)
+        if table is not None:
+            return table
+
     table = dataset.table(table_name)    
     if not table.exists():
-        table = None
+        return None
+
+    # Load the schema, so the cached table has it
+    table.reload()
+    if cache is not None:
+        cache.set(key, table)
     return table
 
 
-def create_dataset(name, project=None, client=None, quiet=False):
+def create_dataset(name, project=None, client=None, quiet=False, cache=None):
     '''create a new dataset with "name" (required) 
     '''
     client = get_client(project, client)
+    key = ('dataset', client.project, name)
+    if cache is not None:
+        dataset = cache.get(key)
+        if dataset is not None:
+            return dataset
 
     # Name for dataset corresponds with IRB (our current "Collection" names)
     dataset = client.dataset(name)
@@ -129,4 +244,652 @@ def create_dataset(name, project=None, client=None, quiet=False):
     
     if not quiet:
         bot.info(message.format(dataset.name))
+    if cache is not None:
+        cache.set(key, dataset)
     return dataset
+
+
+def validate_partitioning(schema, partition=None, partition_field=None, clustering_fields=None):
+    '''return True if the partition and partition field are valid for a
+    schema, otherwise log the error and return False. This
+    google-cloud-bigquery can't create clustered tables, so clustering_fields
+    are an error.
+    '''
+    if clustering_fields is not None:
+        bot.error("Clustering is not supported by this google-cloud-bigquery, remove clustering_fields.")
+        return False
+
+    if partition is not None and partition.upper() not in PARTITION_UNITS:
+        bot.error("partition %s is not supported, choices are %s." %(partition,
+                                                                    ', '.join(PARTITION_UNITS)))
+        return False
+
+    types = dict((field.name, field.field_type.upper()) for field in schema)
+    if partition_field is not None:
+        if partition is None:
+            bot.error("A partition (eg, DAY) is required for partition_field.")
+            return False
+        if types.get(partition_field) not in PARTITION_TYPES:
+            bot.error("partition_field %s must be a %s field in the schema." %(partition_field,
+                                                                              ' or '.join(PARTITION_TYPES)))
+            return False
+    return True
+
+
+def set_partitioning(table, partition=None, partition_field=None, partition_expiration=None):
+    '''set the partitioning for a table, before it is created. The table
+    only has a property for the partition type, so the partition field is
+    set in the timePartitioning resource that is sent on create.
+    '''
+    if partition is None:
+        return table
+
+    table.partitioning_type = partition.upper()
+    if partition_field is not None:
+        # google-cloud-bigquery <= 0.27 (the run_async_query API used here)
+        # has no property for the field. The partitioning_type setter
+        # creates _properties['timePartitioning'], and _build_resource
+        # sends that dict as it is on create()
+        table._properties['timePartitioning']['field'] = partition_field
+    if partition_expiration is not None:
+        table.partition_expiration = partition_expiration
+    return table
+
+
+#######################################################################
+# CACHE AND SCHEMAS ###################################################
+#######################################################################
+
+
+class HandleCache(object):
+    '''a HandleCache keeps dataset and table handles (with their schemas)
+    for ttl seconds, so getting a dataset or table again doesn't need 
+    calls to BigQuery. It is safe to share between threads.
+    '''
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.handles = dict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        '''return the handle for key, or None if missing or expired'''
+        with self.lock:
+            entry = self.handles.get(key)
+            if entry is None:
+                return None
+            handle,expires = entry
+            if expires < time.time():
+                del self.handles[key]
+                return None
+            return handle
+
+    def set(self, key, handle):
+        with self.lock:
+            self.handles[key] = (handle, time.time() + self.ttl)
+        return handle
+
+    def clear(self, key=None):
+        '''remove one handle (by key) or all handles'''
+        with self.lock:
+            if key is None:
+                self.handles = dict()
+            else:
+                self.handles.pop(key, None)
+
+
+def get_schema_key(schema):
+    '''return a (hashable) key for a schema, to compare or cache it'''
+    return tuple((field.name, field.field_type.upper(), field.mode,
+                  get_schema_key(field.fields or ())) for field in schema)
+
+
+def get_schema_diff(current, requested):
+    '''compare the current schema of a table with a requested schema, and
+    return a dictionary with the names of fields that are "added" (only in
+    requested), "removed" (only in current) and "changed" (a different type,
+    mode, or subfields).
+    '''
+    current = dict((field.name, field) for field in current)
+    requested = dict((field.name, field) for field in requested)
+    diff = {'added': [name for name in requested if name not in current],
+            'removed': [name for name in current if name not in requested],
+            'changed': []}
+    for name,field in requested.items():
+        if name in current:
+            if get_schema_key([field]) != get_schema_key([current[name]]):
+                diff['changed'].append(name)
+    return diff
+
+
+def has_schema_changes(diff):
+    '''return True if a schema diff needs a table update. Only added fields
+    do, since BigQuery doesn't remove fields with an update, and rejects
+    changes to the type (or mode) of a field.
+    '''
+    return len(diff['added']) > 0
+
+
+def merge_schema(current, requested):
+    '''return the current schema, with the fields added by the requested
+    schema. Fields in current are kept as they are, also if the requested
+    schema changes them (see get_schema_diff), since BigQuery rejects the
+    update.
+    '''
+    names = [field.name for field in current]
+    return list(current) + [field for field in requested if field.name not in names]
+
+
+#######################################################################
+# ROWS ################################################################
+#######################################################################
+
+
+class RowEncoder(object):
+    '''a RowEncoder is compiled once for a schema, and converts dicts of
+    field names and values into rows (lists of values, in the order of
+    the schema fields) for insert_data. Each value is converted for the
+    type of its field. REPEATED fields are lists, and RECORD fields are
+    dicts (encoded with the subfields of the record).
+    '''
+    def __init__(self, schema):
+        self.plan = [(field.name, get_field_encoder(field)) for field in schema]
+
+    def encode_rows(self, rows):
+        '''encode a list of dicts as rows, skipping anything that isn't a dict'''
+        plan = self.plan
+        return [[encode(rowdict.get(name)) for name,encode in plan]
+                for rowdict in rows if isinstance(rowdict, dict)]
+
+    def encode_record(self, rowdict):
+        '''encode one dict as a dict with only the schema fields (for a RECORD)'''
+        get = rowdict.get
+        return dict((name, encode(get(name))) for name,encode in self.plan)
+
+
+def get_field_encoder(field):
+    '''return a function to convert a value for a SchemaField. None is
+    always kept. A list for a field that isn't REPEATED is joined with
+    commas (as a string), and a single value for a REPEATED field is 
+    made a list. A value that can't be converted (eg, "abc" for an INTEGER)
+    is null (or dropped from a REPEATED field), and a warning with the
+    field and value is logged.
+    '''
+    field_type = field.field_type.upper()
+    if field_type in ['RECORD', 'STRUCT']:
+        record = RowEncoder(field.fields)
+        def convert(value):
+            if isinstance(value, dict):
+                return record.encode_record(value)
+            return None
+    else:
+        convert = FIELD_CONVERTERS.get(field_type, to_string)
+
+    def checked(value):
+        result = convert(value)
+        if result is None:
+            bot.warning("Cannot convert %r to %s for field %s, it is null." %(value,
+                                                                            field_type,
+                                                                            field.name))
+        return result
+
+    if field.mode == 'REPEATED':
+        def encode(value):
+            if value is None:
+                return []
+            if not isinstance(value, (list, tuple)):
+                value = [value]
+            # Arrays can't have nulls, values that can't be converted are dropped
+            values = [checked(x) for x in value if x is not None]
+            return [x for x in values if x is not None]
+    else:
+        def encode(value):
+            if value is None:
+                return None
+            if isinstance(value, (list, tuple)):
+                value = ','.join([str(x) for x in value])
+            return checked(value)
+    return encode
+
+
+def to_string(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    if isinstance(value, dict):
+        return json.dumps(value, default=str)
+    return str(value)
+
+def to_integer(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def to_boolean(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ['true', 't', 'yes', 'y', '1']
+    return bool(value)
+
+def to_timestamp(value):
+    # datetime and date objects are kept, and converted by the writer
+    if hasattr(value, 'isoformat'):
+        return value
+    return to_string(value)
+
+def to_date(value):
+    # a datetime is written with its time, which BigQuery rejects for a DATE
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    return to_timestamp(value)
+
+
+# Converters for each BigQuery type, others are strings (see RowEncoder)
+FIELD_CONVERTERS = {'STRING': to_string,
+                    'INTEGER': to_integer,
+                    'INT64': to_integer,
+                    'FLOAT': to_float,
+                    'FLOAT64': to_float,
+                    'BOOLEAN': to_boolean,
+                    'BOOL': to_boolean,
+                    'TIMESTAMP': to_timestamp,
+                    'DATETIME': to_timestamp,
+                    'DATE': to_date,
+                    'TIME': to_timestamp}
+
+
+#######################################################################
+# LOAD JOBS ###########################################################
+#######################################################################
+
+
+def write_rows(rows, file_name, schema, source_format="json"):
+    '''write rows (lists of values, in the order of the schema fields, 
+    see BigQueryManager._dict_to_rows) to a file for a load job, one at 
+    a time, so rows can come from a generator. Returns the number of rows.
+    :param source_format: json (newline delimited) or avro. Avro requires
+    fastavro, and is only imported here.
+    '''
+    names = [field.name for field in schema]
+    counter = {'rows': 0}
+
+    def records(convert=None):
+        for row in rows:
+            counter['rows'] += 1
+            if convert is not None:
+                row = [f(value) for f,value in zip(convert, row)]
+            yield dict(zip(names, row))
+
+    if source_format == "json":
+        with open(file_name, 'w') as filey:
+            for record in records():
+                filey.write("%s\n" %json.dumps(record, default=to_json))
+
+    elif source_format == "avro":
+        try:
+            import fastavro
+        except ImportError:
+            bot.error("fastavro must be installed to write avro.")
+            sys.exit(1)
+        with open(file_name, 'wb') as filey:
+            convert = [get_avro_converter(field) for field in schema]
+            fastavro.writer(filey, get_avro_schema(schema), records(convert))
+
+    else:
+        bot.error("%s is not a valid format, choices are %s." %(source_format,
+                                                                ', '.join(LOAD_FORMATS)))
+        sys.exit(1)
+
+    return counter['rows']
+
+
+def get_avro_schema(schema, name="Row"):
+    '''return an Avro schema (a dictionary) for a BigQuery schema. All
+    fields are nullable, and types not in AVRO_TYPES are strings. REPEATED
+    fields are arrays, and RECORD fields are (nested) records.
+    '''
+    fields = []
+    for field in schema:
+        field_type = field.field_type.upper()
+        if field_type in ['RECORD', 'STRUCT']:
+            avro_type = get_avro_schema(field.fields, name="%s_%s" %(name, field.name))
+        else:
+            avro_type = AVRO_TYPES.get(field_type, 'string')
+        if field.mode == 'REPEATED':
+            fields.append({'name': field.name,
+                           'type': {'type': 'array', 'items': avro_type},
+                           'default': []})
+        else:
+            fields.append({'name': field.name,
+                           'type': ['null', avro_type],
+                           'default': None})
+    return {'type': 'record', 'name': name, 'fields': fields}
+
+
+def to_json(value):
+    '''serialize values json doesn't know, datetimes as iso format'''
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
+
+
+def get_avro_converter(field):
+    '''return a function to convert a (RowEncoder) value for the Avro type
+    of a field (see get_avro_schema). TIMESTAMP and DATE strings are parsed
+    to datetime and date, and datetimes for string fields are iso format.
+    '''
+    field_type = field.field_type.upper()
+    if field_type in ['RECORD', 'STRUCT']:
+        converters = [(x.name, get_avro_converter(x)) for x in field.fields]
+        def convert(value):
+            if value is None:
+                return None
+            return dict((name, f(value.get(name))) for name,f in converters)
+    elif field_type == 'TIMESTAMP':
+        convert = parse_timestamp
+    elif field_type == 'DATE':
+        def convert(value):
+            value = parse_timestamp(value)
+            if isinstance(value, datetime.datetime):
+                return value.date()
+            return value
+    elif AVRO_TYPES.get(field_type, 'string') == 'string':
+        def convert(value):
+            if hasattr(value, 'isoformat'):
+                return value.isoformat()
+            return value
+    else:
+        return lambda value: value
+
+    if field.mode == 'REPEATED':
+        return lambda values: [convert(x) for x in values or []]
+    return convert
+
+
+# Timestamp strings are parsed with the first of these formats that matches
+TIMESTAMP_FORMATS = ['%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S',
+                     '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S',
+                     '%Y-%m-%d']
+
+# A timestamp can end with a utc offset, eg +00:00 from isoformat()
+TIMESTAMP_OFFSET = re.compile('([+-])([0-9]{2}):?([0-9]{2})$')
+
+
+def parse_timestamp(value):
+    '''parse a timestamp or date string (eg, iso format, with an optional
+    trailing Z or utc offset like +05:00) to a datetime, in UTC. Other
+    values are returned as they are.
+    '''
+    if not isinstance(value, six.string_types):
+        return value
+    text = value.strip()
+    offset = datetime.timedelta(0)
+    if text.endswith('Z'):
+        text = text[:-1]
+    else:
+        match = TIMESTAMP_OFFSET.search(text)
+        if match is not None and match.start() > len('YYYY-MM-DD'):
+            sign,hours,minutes = match.groups()
+            offset = datetime.timedelta(hours=int(hours), minutes=int(minutes))
+            if sign == '-':
+                offset = -offset
+            text = text[:match.start()]
+    for timestamp_format in TIMESTAMP_FORMATS:
+        try:
+            return datetime.datetime.strptime(text, timestamp_format) - offset
+        except ValueError:
+            pass
+    bot.warning("Cannot parse timestamp %s" %value)
+    return None
+
+
+def run_load_job(table, source_uris, source_format="json", project=None, client=None,
+                 write_disposition="WRITE_APPEND", poll_interval=5, timeout=None):
+    '''run_load_job will start a job to load rows into a table from files
+    in storage, and poll every poll_interval seconds until it is done.
+    Returns the job. If the job has errors, or does not finish within 
+    timeout seconds, the error is logged.
+    :param source_uris: a list of gs:// uris of files with rows
+    :param source_format: the format of the files, json or avro
+    '''
+    client = get_client(project, client)
+    if not isinstance(source_uris, list):
+        source_uris = [source_uris]
+
+    job_name = "som-load-%s" %uuid.uuid4()
+    job = client.load_table_from_storage(job_name, table, *source_uris)
+    job.source_format = LOAD_FORMATS.get(source_format, source_format)
+    job.write_disposition = write_disposition
+    job.begin()
+    bot.info("Started load job %s for %s files." %(job_name, len(source_uris)))
+
+    started = time.time()
+    while True:
+        job.reload()
+        if job.state == 'DONE':
+            break
+        if timeout is not None and time.time() - started > timeout:
+            bot.error("Load job %s did not finish in %s seconds." %(job_name, timeout))
+            return job
+        time.sleep(poll_interval)
+
+    if job.error_result is not None:
+        bot.error("Load job %s failed: %s" %(job_name, job.errors))
+    else:
+        bot.info("Load job %s loaded %s rows in %.1f seconds." %(job_name,
+                                                                 job.output_rows,
+                                                                 time.time() - started))
+    return job
+
+
+#######################################################################
+# QUERIES #############################################################
+#######################################################################
+
+# Default number of rows per page, and pages fetched ahead, for queries
+QUERY_PAGE_SIZE = 10000
+QUERY_PREFETCH = 2
+
+
+def run_query(sql, project=None, client=None, legacy_sql=False, poll_interval=1,
+              timeout=None):
+    '''run_query will start a query job for sql, and poll every 
+    poll_interval seconds until it is done. Returns the query results 
+    (to page through with iter_result_pages), or None if the query failed
+    or did not finish within timeout seconds.
+    '''
+    client = get_client(project, client)
+    job_name = "som-query-%s" %uuid.uuid4()
+    job = client.run_async_query(job_name, sql)
+    job.use_legacy_sql = legacy_sql
+    job.begin()
+
+    started = time.time()
+    while True:
+        job.reload()
+        if job.state == 'DONE':
+            break
+        if timeout is not None and time.time() - started > timeout:
+            bot.error("Query %s did not finish in %s seconds." %(job_name, timeout))
+            return None
+        time.sleep(poll_interval)
+
+    if job.error_result is not None:
+        bot.error("Query %s failed: %s" %(job_name, job.errors))
+        return None
+    return job.results()
+
+
+def dry_run_query(sql, project=None, client=None, legacy_sql=False, quiet=False):
+    '''dry_run_query will check sql with a dry run (that is free), and 
+    return the bytes the query would scan, to check that partitions are
+    used (pruned) before running it. Returns None if 
+    the query is invalid.
+    '''
+    client = get_client(project, client)
+    job_name = "som-dryrun-%s" %uuid.uuid4()
+    job = client.run_async_query(job_name, sql)
+    job.use_legacy_sql = legacy_sql
+    job.dry_run = True
+    try:
+        job.begin()
+    except BadRequest as error:
+        bot.error("Invalid query: %s" %error)
+        return None
+
+    total = getattr(job, 'total_bytes_processed', None)
+    if total is None:
+        statistics = job._properties.get('statistics', {})
+        total = statistics.get('query', statistics).get('totalBytesProcessed', 0)
+    total = int(total)
+    if not quiet:
+        bot.info("Query will process %.2f MB." %(total / (1024.0 * 1024)))
+    return total
+
+
+def iter_result_pages(results, page_size=None, prefetch=None):
+    '''iter_result_pages is a generator of (names, rows) for each page of
+    query results, where rows is a list of tuples (values in the order
+    of names). The next pages (at most prefetch) are fetched in a 
+    background thread while the current page is used, so memory is
+    bounded by prefetch + 1 pages.
+    '''
+    if page_size is None:
+        page_size = QUERY_PAGE_SIZE
+    if prefetch is None:
+        prefetch = QUERY_PREFETCH
+
+    pages = queue.Queue(maxsize=max(prefetch, 1))
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch():
+        try:
+            # max_results caps the rows of the whole iterator, so each page
+            # is fetched with its own iterator, from the last page token
+            token = None
+            while True:
+                iterator = results.fetch_data(max_results=page_size,
+                                              page_token=token)
+                page = next(iterator.pages, None)
+                rows = [tuple(row) for row in page or []]
+                names = [field.name for field in results.schema]
+                if not put((names, rows)):
+                    return
+                token = iterator.next_page_token
+                if token is None:
+                    break
+            put(done)
+        except Exception as error:
+            put(error)
+
+    thread = threading.Thread(target=fetch)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item = pages.get()
+            if item is done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+def get_arrow_schema(schema, pyarrow):
+    '''return a pyarrow schema for a BigQuery schema. Types not in
+    ARROW_TYPES are strings, timestamps are in UTC, REPEATED fields are
+    lists, and RECORD fields are (nested) structs.
+    '''
+    fields = []
+    for field in schema:
+        field_type = field.field_type.upper()
+        if field_type in ['RECORD', 'STRUCT']:
+            arrow_type = pyarrow.struct(list(get_arrow_schema(field.fields, pyarrow)))
+        elif field_type == 'TIMESTAMP':
+            arrow_type = pyarrow.timestamp('us', tz='UTC')
+        else:
+            arrow_type = getattr(pyarrow, ARROW_TYPES.get(field_type, 'string'))()
+        if field.mode == 'REPEATED':
+            arrow_type = pyarrow.list_(arrow_type)
+        fields.append(pyarrow.field(field.name, arrow_type))
+    return pyarrow.schema(fields)
+
+
+def iter_result_rows(pages):
+    '''yield each row (a dict of names and values) from iter_result_pages'''
+    for names,rows in pages:
+        for row in rows:
+            yield dict(zip(names, row))
+
+
+def get_result_columns(pages, output="numpy", results=None):
+    '''get_result_columns converts pages (from iter_result_pages) to columns,
+    page by page, without making a dict for each row. Each page is 
+    converted to arrays before the next is read, and then the arrays for
+    a column are joined. numpy and pyarrow are optional, and only 
+    imported here.
+    :param output: "numpy" for a dictionary of numpy arrays by name, or
+    "arrow" for a pyarrow Table.
+    :param results: the query results the pages are from. For arrow, every
+    page is converted with the types from results.schema (which the client
+    fills in with the first page), so a page with only nulls in a column
+    still has the same schema as the others.
+    '''
+    try:
+        if output == "numpy":
+            import numpy
+            convert = numpy.asarray
+        elif output == "arrow":
+            import pyarrow
+            convert = pyarrow.array
+        else:
+            bot.error("%s is not a valid output, choices are numpy or arrow." %output)
+            sys.exit(1)
+    except ImportError:
+        bot.error("%s must be installed for output %s." %(output,output))
+        sys.exit(1)
+
+    arrow_schema = None
+    names = []
+    chunks = []
+    for names,rows in pages:
+        if output == "arrow" and results is not None and arrow_schema is None:
+            arrow_schema = get_arrow_schema(results.schema, pyarrow)
+        if rows:
+            columns = zip(*rows)
+            if arrow_schema is not None:
+                chunks.append([pyarrow.array(list(column), type=field.type)
+                               for column,field in zip(columns, arrow_schema)])
+            else:
+                chunks.append([convert(list(column)) for column in columns])
+
+    if output == "arrow":
+        if arrow_schema is not None:
+            batches = [pyarrow.RecordBatch.from_arrays(arrays, schema=arrow_schema)
+                       for arrays in chunks]
+            return pyarrow.Table.from_batches(batches, schema=arrow_schema)
+        batches = [pyarrow.RecordBatch.from_arrays(arrays, names) for arrays in chunks]
+        if not batches:
+            return pyarrow.Table.from_arrays([pyarrow.array([]) for name in names], names)
+        return pyarrow.Table.from_batches(batches)
+
+    if not chunks:
+        return dict((name, numpy.asarray([])) for name in names)
+    return dict((name, numpy.concatenate([arrays[i] for arrays in chunks]))
+                for i,name in enumerate(names))
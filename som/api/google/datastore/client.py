@@ -33,9 +33,13 @@ from .models import (
 
 from .models import DataStoreManager
 from som.api.google.storage.client import StorageClientBase
+from som.api.google.storage.utils import get_storage_fields
+from som.api.google.utils import get_cloud_client
 from google.cloud import datastore
+from concurrent.futures import ThreadPoolExecutor
 from som.logger import bot
 import six
+import os
 
 ######################################################################################
 # Specs and base data structures for a general model
@@ -101,7 +105,7 @@ class DataStoreClient(StorageClientBase):
 
     def __init__(self, project, bucket_name, **kwargs):
         super(DataStoreClient, self).__init__(project, bucket_name, **kwargs)
-        self.datastore = datastore.Client(self.project)
+        self.datastore = get_cloud_client('datastore', self.project)
         self.name = "datastore"
         self.batch = DataStoreManager(client=self.datastore)
 
@@ -162,8 +166,10 @@ class DataStoreClient(StorageClientBase):
                               keys_only=keys_only)
 
 
-    def get_entities(self,collection=None,field=None,uids=None,limit=None,keys_only=False):
+    def get_entities(self,collection=None,field=None,uids=None,limit=None,keys_only=False,
+                     workers=None):
         '''eg:     pmc_articles = client.get_entities(uids=pmc_keys,field="pmcid")
+        With a field and many uids, set workers to run the lookups in parallel.
         '''  
         ancestor = None
         if collection is not None:
@@ -173,7 +179,8 @@ class DataStoreClient(StorageClientBase):
                               field=field,
                               ancestor=ancestor,
                               keys=uids,
-                              keys_only=keys_only)
+                              keys_only=keys_only,
+                              workers=workers)
 
 
     def get_images(self,entity,limit=None,keys_only=False):
@@ -210,33 +217,54 @@ class DataStoreClient(StorageClientBase):
             bot.warning("You must specify object_type. Image or Text.")
             return None
 
-        uid = self.get_storage_path(file_path,entity)
+        # Returns none on httperror, if object already exists
+        storage_obj = self.upload_storage(file_path=file_path,
+                                          entity=entity,
+                                          permission=permission,
+                                          mimetype=mimetype)
+
+        return self.add_storage_object(storage_obj=storage_obj,
+                                       file_path=file_path,
+                                       entity=entity,
+                                       object_type=object_type,
+                                       batch=batch,
+                                       fields=fields)
+
+
+    def upload_storage(self,file_path,entity,permission=None,mimetype=None):
+        '''upload_storage will upload a file to Google Storage in the folder
+        for the entity, and return the storage object (or None on error).
+        It does not touch Datastore, and is safe to call from worker threads.
+        '''
         bucket_folder = self.get_storage_path(file_path,
                                               entity,
                                               return_folder=True)
 
-        # Returns none on httperror, if object already exists
-        storage_obj = self.put_object(file_path=file_path,
-                                      bucket_folder=bucket_folder,
-                                      permission=permission,
-                                      mimetype=mimetype)
+        return self.put_object(file_path=file_path,
+                               bucket_folder=bucket_folder,
+                               permission=permission,
+                               mimetype=mimetype)
+
 
+    def add_storage_object(self,storage_obj,file_path,entity,object_type,
+                           batch=True,fields=None):
+        '''add_storage_object will create the Datastore object for an
+        uploaded storage object, and add it to the batch manager if batch
+        is True. If storage_obj is None (upload failed) None is returned.
+        '''
         # We created it
         if storage_obj is None:
             return storage_obj
 
-        storage_fields = get_storage_fields(storage_obj)
-        if fields is not None:
-            storage_fields.update(fields)
-        fields = storage_fields
-
-
-        url = "https://storage.googleapis.com/%s/%s" %(self.bucket['name'],
-                                                       storage_obj['name'])
+        model,fields = self.get_object_model(storage_obj=storage_obj,
+                                             file_path=file_path,
+                                             entity=entity,
+                                             object_type=object_type,
+                                             fields=fields)
 
-        new_object = self.create_object(uid=uid,
+        new_object = self.create_object(uid=self.get_storage_path(file_path,entity),
                                         entity=entity,
-                                        url=url,
+                                        url=self.get_object_url(storage_obj),
                                         fields=fields,
                                         object_type=object_type,
                                         create=not batch)
@@ -246,6 +274,30 @@ class DataStoreClient(StorageClientBase):
         return new_object
 
 
+    def get_object_model(self,storage_obj,file_path,entity,object_type,fields=None):
+        '''get_object_model returns the model spec (see storageObject) and
+        fields (storage fields, updated with any user fields) for an
+        uploaded storage object, without any calls to Datastore.
+        '''
+        uid = self.get_storage_path(file_path,entity)
+        storage_fields = get_storage_fields(storage_obj)
+        if fields is not None:
+            storage_fields.update(fields)
+        fields = storage_fields
+
+        model = storageObject(uid=uid,
+                              entity=entity,
+                              url=self.get_object_url(storage_obj),
+                              storage_type=object_type)
+        return model,fields
+
+
+    def get_object_url(self,storage_obj):
+        '''return the public url for an object in the client's bucket'''
+        return "https://storage.googleapis.com/%s/%s" %(self.bucket['name'],
+                                                        storage_obj['name'])
+
+
     def upload_text(self,text,entity,batch=True,fields=None,permission=None,mimetype=None):
         '''upload_text will add a text object to the batch manager'''
         new_object = self.upload_object(file_path=text,
@@ -283,7 +335,8 @@ class DataStoreClient(StorageClientBase):
                        entity_metadata=None,
                        images_metadata=None,
                        texts_metadata=None,
-                       batch=True):
+                       batch=True,
+                       workers=None):
 
         '''upload takes a list of images, texts, and optional metadata
         and uploads to datastore (metadata) and storage (images)
@@ -294,6 +347,8 @@ class DataStoreClient(StorageClientBase):
         :param images_metadata: the same, but for images
         :param collection: should be the collection to add the entity to
         :param batch: add entities in batches (recommended, default True)
+        :param workers: if greater than 1, upload objects to storage in parallel
+        with a pool of this many threads. Default None uploads one at a time.
         '''
         if permission is None:
             permission = "projectPrivate"
@@ -306,37 +361,139 @@ class DataStoreClient(StorageClientBase):
 
         if entity_metadata is not None:
             entity.update(fields=entity_metadata)
-       
-        if texts is not None:
 
-            for text in texts:
-                fields = None
+        # Each upload is (file_path, object_type, mimetype, fields)
+        uploads = []
 
+        if texts is not None:
+            for text in texts:
                 # metadata provided for the text?
-                if text in texts_metadata:
-                    fields = texts_metadata[text]
-
-                self.upload_text(text=text,
-                                 entity=entity,
-                                 mimetype=texts_mimetype,
-                                 fields=fields,
-                                 batch=batch,
-                                 permission=permission)
+                fields = texts_metadata.get(text)
+                uploads.append((text, "Text", texts_mimetype, fields))
 
         if images is not None:
             for img in images:
-                fields = None
                 # metadata provided for the image?
-                if img in images_metadata:
-                    fields = images_metadata[img]
-
-                self.upload_image(image=img,
-                                  entity=entity,
-                                  fields=fields,
-                                  mimetype=images_mimetype,
-                                  batch=batch,
-                                  permission=permission)
+                fields = images_metadata.get(img)
+                uploads.append((img, "Image", images_mimetype, fields))
+
+        storage_objs = self.upload_storage_objects(uploads=uploads,
+                                                   entity=entity,
+                                                   permission=permission,
+                                                   workers=workers)
+
+        # With batch, objects are upserted together (one lookup per chunk)
+        models = []
+        for upload,storage_obj in zip(uploads,storage_objs):
+            file_path,object_type,mimetype,fields = upload
+            if storage_obj is None:
+                continue
+            if batch:
+                models.append(self.get_object_model(storage_obj=storage_obj,
+                                                    file_path=file_path,
+                                                    entity=entity,
+                                                    object_type=object_type,
+                                                    fields=fields))
+            else:
+                new_object = self.add_storage_object(storage_obj=storage_obj,
+                                                     file_path=file_path,
+                                                     entity=entity,
+                                                     object_type=object_type,
+                                                     batch=False,
+                                                     fields=fields)
+                bot.debug('%s: %s' %(object_type.upper(),new_object))
 
         # Run a transaction for put (insert) images and text, and clears queue
         if batch:
-            self.batch.runInsert()
+            self.batch.upsert(models)
+
+
+    def upload_compressed(self,compressed_file,collection,
+                          permission=None,
+                          batch=True):
+
+        '''upload_compressed takes a compressed dataset (.zip or .tar.gz) in
+        the WordFish standard, and uploads the entities, images and texts
+        to datastore (metadata) and storage without extracting it. Each
+        member is streamed from the archive to storage, and the archive is
+        read only twice (once for the structure and metadata, once to upload).
+        :param compressed_file: the .zip or .tar.gz with the dataset
+        :param collection: should be the collection to add the entities to
+        :param batch: add entities in batches (recommended, default True)
+        '''
+        from som.wordfish.structures import structure_archive
+        from som.utils import iter_compressed
+
+        if permission is None:
+            permission = "projectPrivate"
+
+        # Archive member name -> (entity, object_type, fields)
+        members = dict()
+        for structure in structure_archive(compressed_file):
+            for item in structure['collection'].get('entities',[]):
+                values = item['entity']
+                entity = self.create_entity(collection=collection,
+                                            uid=os.path.basename(values['id']))
+                if 'metadata' in values:
+                    entity.update(fields=values['metadata'])
+
+                for key,object_type in [('images','Image'),('texts','Text')]:
+                    for obj in values.get(key,[]):
+                        members[obj['original']] = (entity,
+                                                    object_type,
+                                                    obj.get('metadata'))
+
+        models = []
+        for name,fileobj in iter_compressed(compressed_file):
+            if name not in members:
+                continue
+            entity,object_type,fields = members[name]
+            bucket_folder = self.get_storage_path(name,
+                                                  entity,
+                                                  return_folder=True)
+
+            storage_obj = self.put_fileobj(bucket_folder=bucket_folder,
+                                           fileobj=fileobj,
+                                           file_name=name,
+                                           permission=permission)
+            if storage_obj is None:
+                bot.error('Error uploading %s' %name)
+                continue
+
+            if batch:
+                models.append(self.get_object_model(storage_obj=storage_obj,
+                                                    file_path=name,
+                                                    entity=entity,
+                                                    object_type=object_type,
+                                                    fields=fields))
+            else:
+                new_object = self.add_storage_object(storage_obj=storage_obj,
+                                                     file_path=name,
+                                                     entity=entity,
+                                                     object_type=object_type,
+                                                     batch=False,
+                                                     fields=fields)
+                bot.debug('%s: %s' %(object_type.upper(),new_object))
+
+        if batch:
+            self.batch.upsert(models)
+
+
+    def upload_storage_objects(self,uploads,entity,permission,workers=None):
+        '''upload a list of (file_path, object_type, mimetype, fields) to
+        storage, and return the storage objects (None for failed uploads) in
+        the same order. If workers is greater than 1, the uploads are done
+        with a bounded pool of that many threads.
+        '''
+        kwargs = [{'file_path': file_path,
+                   'entity': entity,
+                   'permission': permission,
+                   'mimetype': mimetype}
+                  for file_path,object_type,mimetype,fields in uploads]
+
+        if workers is None or workers <= 1:
+            return [self.upload_storage(**kw) for kw in kwargs]
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self.upload_storage,**kw) for kw in kwargs]
+            return [future.result() for future in futures]
@@ -24,27 +24,50 @@ SOFTWARE.
 '''
 
 from .validators import validate_model
-from som.api.google.utils import get_google_service
+from som.api.google.utils import get_cloud_client
 from som.api.google.models import BatchManager, ModelBase
 import google.cloud.datastore as datastore
 
 from retrying import retry
 from .utils import (
+    convert_columns,
+    get_ancestor_name,
     get_key_filters,
     parse_keys
 )
 
 from google.cloud.exceptions import (
     BadRequest,
+    GoogleCloudError,
     GrpcRendezvous
 )
+from concurrent.futures import ThreadPoolExecutor
 from som.logger import bot
 import datetime
 import collections
 import sys
+import time
 import os
 
 
+# Datastore allows at most 500 mutations (entities) in one commit,
+# and 1000 keys in one lookup
+DATASTORE_MAX_MUTATIONS = 500
+DATASTORE_MAX_LOOKUPS = 1000
+
+# Default number of entities to fetch per page when streaming a query
+DATASTORE_PAGE_SIZE = 1000
+
+# Marks a field missing from an entity, where None is a valid value
+MISSING = object()
+
+# A projection query without the indexes it needs is rejected with these
+try:
+    from google.cloud.exceptions import FailedPrecondition
+    PROJECTION_ERRORS = (BadRequest, FailedPrecondition)
+except ImportError:
+    PROJECTION_ERRORS = (BadRequest,)
+
 
 
 ################################################################################
@@ -54,11 +77,33 @@ import os
 
 class DataStoreManager(BatchManager):
     '''a batch manager that sends metadata to Google DataStore
+
+       Parameters
+       ==========
+       chunk_size: the number of entities to put in each commit, at most
+                   (and by default) DATASTORE_MAX_MUTATIONS
+       flush_size: if defined, runInsert is called when add() has queued
+                   this many tasks, to keep memory flat for long ingests.
+                   Tasks that failed to insert (failed_tasks) don't count,
+                   and are only retried by an explicit runInsert
+       page_size: the default number of entities per page for iter_query
+       workers: the default number of threads to run queued queries with
     '''
-    def __init__(self, **kwargs):
+    def __init__(self, chunk_size=None, flush_size=None, page_size=None,
+                 workers=None, **kwargs):
         super(DataStoreManager, self).__init__(**kwargs)
         if self.client is None:
-            self.client = datastore.Client()
+            self.client = get_cloud_client('datastore')
+        if chunk_size is None or chunk_size > DATASTORE_MAX_MUTATIONS:
+            chunk_size = DATASTORE_MAX_MUTATIONS
+        self.chunk_size = chunk_size
+        self.flush_size = flush_size
+        self.failed_tasks = []
+        if page_size is None:
+            page_size = DATASTORE_PAGE_SIZE
+        self.page_size = page_size
+        self.workers = workers
+        self.query_times = []
 
     def get_kinds(self):
         query = self.client.query(kind='__kind__')
@@ -66,7 +111,8 @@ class DataStoreManager(BatchManager):
         return [entity.key.id_or_name for entity in query.fetch()]
 
 
-    def get(self,kind,keys=None,limit=None,field=None,keys_only=False,ancestor=None):
+    def get(self,kind,keys=None,limit=None,field=None,keys_only=False,ancestor=None,
+            workers=None):
         if keys is None:
             return self.query(kind=kind,
                               limit=limit,
@@ -82,7 +128,7 @@ class DataStoreManager(BatchManager):
                     query = self.client.query(kind=kind.capitalize())
                     query.add_filter(field,'=',key)
                     self.add(query)
-                return self.runQueries()                    
+                return self.runQueries(workers=workers)
 
 
     def add(self,task):
@@ -94,6 +140,64 @@ class DataStoreManager(BatchManager):
             if not isinstance(task,datastore.Entity):
                 task = task._Entity
             self.tasks.append(task)
+            if self.flush_size is not None and len(self.tasks) >= self.flush_size:
+                bot.debug("Queue reached %s tasks, flushing." %len(self.tasks))
+                self.runInsert(retry_failed=False)
+
+
+    def upsert(self,models,save=True):
+        '''upsert will update or create many models at once. Existing entities
+        are looked up with one get_multi per chunk of keys, fields are merged
+        the same way as DataStoreBase.update_or_create, and the entities
+        are added to the queue, to be written with chunked put_multi.
+        :param models: a list of model specs (dictionaries with fields and key,
+        and optionally exclude_from_indexes, eg from storageObject) or of
+        tuples (spec, fields) with additional fields for the model.
+        :param save: run the insert (default True), otherwise only queue.
+        Returns the list of entities, in the order of models.
+        '''
+        specs = []
+        for model in models:
+            fields = None
+            if isinstance(model,tuple):
+                model,fields = model
+            specs.append((self.client.key(*model['key']), model, fields))
+
+        # One lookup per chunk, instead of one get per model
+        keys = list(collections.OrderedDict((key,None) for key,m,f in specs))
+        existing = dict()
+        for start in range(0, len(keys), DATASTORE_MAX_LOOKUPS):
+            for entity in self._lookup_chunk(keys[start:start + DATASTORE_MAX_LOOKUPS]):
+                existing[entity.key] = entity
+
+        now = datetime.datetime.utcnow()
+        entities = collections.OrderedDict()
+        for key,model,fields in specs:
+            entity = entities.get(key, existing.get(key))
+
+            # The entity is being created, add timestamp and model fields
+            if entity is None:
+                entity = datastore.Entity(key=key,
+                                          exclude_from_indexes=model.get('exclude_from_indexes') or ())
+                entity['created'] = now
+                entity.update(validate_model(model['fields']))
+
+            entity['updated'] = now
+            if fields is not None:
+                entity.update(fields)
+            entities[key] = entity
+
+        for entity in entities.values():
+            self.add(entity)
+        if save:
+            self.runInsert()
+        return [entities[key] for key,m,f in specs]
+
+
+    @retry(wait_exponential_multiplier=1000,wait_exponential_max=10000,stop_max_attempt_number=5)
+    def _lookup_chunk(self,keys):
+        '''get the entities that exist for a chunk of keys'''
+        return self.client.get_multi(keys)
 
 
     def delete(self,keys):
@@ -105,32 +209,95 @@ class DataStoreManager(BatchManager):
                                                   # (currently on airplane)
 
 
-    @retry(wait_exponential_multiplier=1000,wait_exponential_max=10000,stop_max_attempt_number=5)
-    def runInsert(self,clear_queue=True):
-       '''runInsert will run a transaction for a set of tasks
+    def runInsert(self,clear_queue=True,retry_failed=True):
+       '''runInsert will run a transaction for a set of tasks, split into
+       chunks of at most chunk_size entities. Each chunk is retried on its
+       own, and chunks that still fail are kept in failed_tasks (when
+       clear_queue is True), apart from the queue, so they don't count
+       toward flush_size. Failed tasks are sent again first, unless
+       retry_failed is False (as for the flushes from add).
+       Returns the list of inserted tasks, or None if there are no tasks.
        '''
+       pending = self.tasks
+       if retry_failed:
+           pending = self.failed_tasks + self.tasks
+
        tasks = None
-       if len(self.tasks) > 0:
-           tasks = self.tasks
-           with self.client.transaction():
-               self.client.put_multi(tasks)
+       if len(pending) > 0:
+           tasks = []
+           failed = []
+           for start in range(0, len(pending), self.chunk_size):
+               chunk = pending[start:start + self.chunk_size]
+               try:
+                   self._insert_chunk(chunk)
+                   tasks.extend(chunk)
+               except (GoogleCloudError, GrpcRendezvous) as error:
+                   bot.error("Error inserting %s tasks: %s" %(len(chunk), error))
+                   failed.extend(chunk)
+
+           if failed:
+               bot.warning("%s of %s tasks were not inserted." %(len(failed),
+                                                                 len(pending)))
            if clear_queue:
                self.tasks = []
+               if retry_failed:
+                   self.failed_tasks = failed
+               else:
+                   self.failed_tasks.extend(failed)
        return tasks
-       
+
+
     @retry(wait_exponential_multiplier=1000,wait_exponential_max=10000,stop_max_attempt_number=5)
-    def runQueries(self,clear_queue=True):
+    def _insert_chunk(self,chunk):
+       '''insert a single chunk of tasks (no larger than a commit allows)
+       in one transaction.
+       '''
+       with self.client.transaction():
+           self.client.put_multi(chunk)
+       
+    def runQueries(self,clear_queue=True,workers=None):
+       '''runQueries will run the queued queries, each retried on its own,
+       and return the combined results in the order the queries were added.
+       If workers (or the manager's workers) is greater than 1, the queries
+       are run concurrently on a pool of that many threads. The latency of
+       each query (in seconds) is saved in query_times, in the same order.
+       '''
+       if workers is None:
+           workers = self.workers
+
        results = None
        if len(self.queries) > 0:
+           queries = self.queries
+           if workers is not None and workers > 1:
+               with ThreadPoolExecutor(max_workers=workers) as executor:
+                   timed = list(executor.map(self._run_query, queries))
+           else:
+               timed = [self._run_query(query) for query in queries]
+
            results = []
-           for query in self.queries:
-               result = [x for x in query.fetch()]
-               results = results + result
+           self.query_times = []
+           for result,seconds in timed:
+               results.extend(result)
+               self.query_times.append(seconds)
+
+           bot.debug("Ran %s queries in %.2f seconds (max %.2f)" %(len(timed),
+                                                                   sum(self.query_times),
+                                                                   max(self.query_times)))
            if clear_queue:
                self.queries = []
        return results
 
 
+    @retry(wait_exponential_multiplier=1000,wait_exponential_max=10000,stop_max_attempt_number=5)
+    def _run_query(self,query):
+       '''run a single query, returning the list of results and the
+       time it took in seconds.
+       '''
+       start = time.time()
+       result = list(query.fetch())
+       return result, time.time() - start
+
+
     def query(self,kind=None,filters=None,order=None,projections=None,
               run=True,limit=None,keys_only=False,distinct_on=None,query=None,
               ancestor=None):
@@ -203,6 +370,97 @@ class DataStoreManager(BatchManager):
         return result
 
 
+    def iter_query(self,page_size=None,start_cursor=None,limit=None,**kwargs):
+        '''iter_query is a generator version of query, yielding entities
+        one at a time while fetching them in pages, so the full result is
+        never held in memory. Other arguments are passed to query.
+        :param page_size: the number of entities to fetch per request
+        :param start_cursor: resume from a cursor saved from iter_pages
+        :param limit: an integer limit of results to return, total
+        '''
+        for page,cursor in self.iter_pages(page_size=page_size,
+                                           start_cursor=start_cursor,
+                                           limit=limit,
+                                           **kwargs):
+            for entity in page:
+                yield entity
+
+
+    def iter_pages(self,page_size=None,start_cursor=None,limit=None,**kwargs):
+        '''iter_pages runs a query with cursors, yielding a tuple with a list
+        of entities for each page, and the cursor to resume after that page.
+        A cursor of None means there are no more results. See iter_query.
+        '''
+        if page_size is None:
+            page_size = self.page_size
+
+        query = self.query(run=False, **kwargs)
+        cursor = start_cursor
+        remaining = limit
+        while remaining is None or remaining > 0:
+            fetch_size = page_size
+            if remaining is not None:
+                fetch_size = min(page_size, remaining)
+
+            page,cursor = self._fetch_page(query, fetch_size, cursor)
+            if remaining is not None:
+                remaining -= len(page)
+
+            # The page has every batch up to fetch_size, so a short (or
+            # empty) page means the query is exhausted
+            if len(page) < fetch_size:
+                cursor = None
+            yield page,cursor
+            if cursor is None:
+                break
+
+
+    def count(self,kind,filters=None,ancestor=None,group_by=None,page_size=None):
+        '''count the entities of a kind with a keys only query, streamed in
+        pages, so that no entity bodies are downloaded or kept in memory.
+        :param kind: the kind of model to count (eg 'Image')
+        :param filters: a list of filters, as for query
+        :param ancestor: if provided, only count descendants of the ancestor
+        :param group_by: an ancestor kind (eg 'Collection') to group by. If
+        provided, a dictionary of counts keyed by ancestor name is returned.
+        '''
+        if group_by is not None:
+            counts = collections.Counter()
+        else:
+            counts = 0
+
+        for page,cursor in self.iter_pages(kind=kind,
+                                           filters=filters,
+                                           ancestor=ancestor,
+                                           keys_only=True,
+                                           page_size=page_size):
+            if group_by is None:
+                counts += len(page)
+                continue
+            for entity in page:
+                counts[get_ancestor_name(entity.key,group_by)] += 1
+
+        if group_by is not None:
+            counts = dict(counts)
+        return counts
+
+
+    @retry(retry_on_exception=lambda error: not isinstance(error,PROJECTION_ERRORS),
+           wait_exponential_multiplier=1000,wait_exponential_max=10000,stop_max_attempt_number=5)
+    def _fetch_page(self,query,page_size,start_cursor=None):
+        '''fetch a single page of results for a query, returning the list
+        of entities and the cursor for the next page. A batch from Datastore
+        can be short (eg, at the batch byte limit) with more results still
+        to come, so the batches are read until page_size entities, or the
+        query has no more results.
+        '''
+        iterator = query.fetch(limit=page_size, start_cursor=start_cursor)
+        page = []
+        for batch in iterator.pages:
+            page.extend(batch)
+        return page, iterator.next_page_token
+
+
     def query_key(self,kind,keys,**kwargs):
         '''query_key is an entry to query that adds a key filter to the query
         '''
@@ -245,35 +503,88 @@ class DataStoreManager(BatchManager):
         return self.query(**kwargs)
         
 
-    def projection(self,query,projections,add_loners=False):
+    def projection(self,query,projections,add_loners=False,output=None,page_size=None):
         '''extract a subset of a query, meaning a dictionary with key value
-        pairs for field/results lists. By default, to preserve indexing,
-        only objects with all projection fields are added to the result.
-        You can change this behavior by setting add_loners = True
+        pairs for field/results lists (one list, or column, per field).
+        By default, a Datastore projection query is run so only the requested
+        properties are fetched, streamed in pages. To preserve indexing, only
+        objects with all projection fields are added to the result, which is
+        also what Datastore returns for a projection query. You can change
+        this behavior by setting add_loners = True, in which case full
+        entities are fetched and missing fields are added as None.
+
+        A projection query needs every projected property to be indexed (not
+        in exclude_from_indexes, eg "url" of a storage object), and a
+        projection on more than one property needs a composite index for
+        them (index.yaml). If the projection query is rejected, or returns
+        nothing while the query has entities (the properties aren't
+        indexed), the full entities are fetched instead.
+        :param output: None (default) returns lists, "numpy" returns numpy
+        arrays, and "pandas" returns a DataFrame with a column per field.
         ''' 
         if not isinstance(projections,list):
             projections = [projections]
 
-        # Find a more elegant way to do this
-        results = dict()
-        for projection in projections:
-            results[projection] = []
-                    
-        for task in query.fetch():
-            loner = False
-            for p in projections: 
-                if p not in task:
-                    longer=True
-                    break
-
-            # Find more elegant way to not need to loop twice    
-            for p in projections:
-                if not loner or (loner and add_loners):
-                    results[p].append(task[p])
-
+        # Projected properties must be indexed, and entities without them
+        # are not returned, so loners need the full entity
+        columns = None
+        if not add_loners:
+            columns = self._projection_columns(query,projections,page_size)
+        if columns is None:
+            columns = self._entity_columns(query,projections,add_loners,page_size)
+
+        results = dict(zip(projections,columns))
+        if output is not None:
+            results = convert_columns(results,output,projections)
         return results
 
 
+    def _projection_columns(self,query,projections,page_size=None):
+        '''run query as a projection query, and return a list of values (a
+        column) for each projection. Returns None if the projection query
+        is rejected, or finds nothing when the query has entities.
+        '''
+        query.projection = projections
+        columns = [[] for p in projections]
+        try:
+            for page,cursor in self.iter_pages(query=query,page_size=page_size):
+                for task in page:
+                    for column,p in zip(columns,projections):
+                        column.append(task.get(p))
+        except PROJECTION_ERRORS as error:
+            bot.warning("Projection query failed (%s), fetching full entities." %error)
+            query.projection = []
+            return None
+
+        query.projection = []
+        if projections and not columns[0]:
+            # Nothing projected, check that there is nothing at all
+            query.keys_only()
+            page,cursor = self._fetch_page(query,1)
+            query.projection = []
+            if page:
+                bot.warning("%s not indexed, fetching full entities." %', '.join(projections))
+                return None
+        return columns
+
+
+    def _entity_columns(self,query,projections,add_loners=False,page_size=None):
+        '''fetch the full entities for query, and return a list of values
+        (a column) for each projection. Entities missing a projection are
+        skipped, or added with None if add_loners is True.
+        '''
+        columns = [[] for p in projections]
+        for page,cursor in self.iter_pages(query=query,page_size=page_size):
+            for task in page:
+                row = [task.get(p, MISSING) for p in projections]
+                if any(x is MISSING for x in row):
+                    if not add_loners:
+                        continue
+                    row = [None if x is MISSING else x for x in row]
+                for column,value in zip(columns,row):
+                    column.append(value)
+        return columns
+
 
 
 ################################################################################
@@ -299,7 +610,7 @@ class DataStoreBase(ModelBase):
 
         super(ModelBase, self).__init__(**kwargs)
         if client is None:
-            client = datastore.Client()
+            client = get_cloud_client('datastore')
         self.client = client
         self._fields = validate_model(self.model['fields'])
         self._key = self.client.key(*self.model['key'])
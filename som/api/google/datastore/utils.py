@@ -61,6 +61,38 @@ def print_datastore_path(name):
     return "/".join([":".join(x) for x in parts])
 
 
+def get_ancestor_name(key,kind):
+    '''get_ancestor_name will return the name (or id) of the ancestor of
+    a given kind in a key's path, eg the collection name for an Image key
+    with kind "Collection". If the key has no such ancestor, None is returned.
+    '''
+    path = list(key.flat_path)
+    for i in range(0, len(path) - 1, 2):
+        if path[i] == kind:
+            return path[i+1]
+    return None
+
+
+def convert_columns(results,output,columns=None):
+    '''convert a dictionary of field/results lists to numpy arrays
+    (output="numpy") or a pandas DataFrame (output="pandas"). numpy and
+    pandas are optional, and only imported here.
+    '''
+    try:
+        if output == "numpy":
+            import numpy
+            return dict((k,numpy.asarray(v)) for k,v in results.items())
+        elif output == "pandas":
+            import pandas
+            return pandas.DataFrame(results,columns=columns)
+    except ImportError:
+        bot.error("%s must be installed for output %s." %(output,output))
+        sys.exit(1)
+
+    bot.error("%s is not a valid output, choices are numpy or pandas." %output)
+    sys.exit(1)
+
+
 ######################################################################################
 # Testing/Retry Functions
 ######################################################################################
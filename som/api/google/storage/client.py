@@ -29,7 +29,10 @@ SOFTWARE.
 
 from .utils import (
     get_bucket,
-    upload_file
+    index_bucket,
+    iter_bucket,
+    upload_file,
+    upload_fileobj
 )
 from som.api.google.utils import get_google_service
 from som.api import ApiConnection
@@ -42,12 +45,27 @@ class StorageClientBase(ApiConnection):
            google.bigquery.BigQueryClient
     '''
 
-    def __init__(self, project, bucket_name, **kwargs):
+    def __init__(self, project, bucket_name, dedup=False, composite_threshold=None,
+                 composite_workers=None, upload_journal=None, controller=None, **kwargs):
         super(ApiConnection, self).__init__(**kwargs)
         self.project = project
         self.storage = get_google_service('storage', 'v1')
         self.bucket_name = bucket_name
 
+        # If dedup, files already in storage (same md5) are not uploaded
+        self.dedup = dedup
+        self.hash_index = dict()
+
+        # Files larger than composite_threshold bytes are uploaded in parts
+        self.composite_threshold = composite_threshold
+        self.composite_workers = composite_workers
+
+        # If defined, a file to save upload sessions in, to resume uploads
+        self.upload_journal = upload_journal
+
+        # If defined, a TrafficController to limit bandwidth and requests
+        self.controller = controller
+
         if self.bucket_name is not None:
             self.get_bucket()
 
@@ -64,13 +82,68 @@ class StorageClientBase(ApiConnection):
         return self.name()
 
 
-    def put_object(self,bucket_folder,file_path, verbose=True,permission=None, mimetype=None):
-        '''upload_object will upload a file to path bucket_path in storage
+    def get_storage(self):
+        '''get_storage returns the storage service for the calling thread.
+        The discovery service (httplib2) is not thread safe, so worker
+        threads are each given their own (pooled) service.
+        '''
+        return get_google_service('storage', 'v1')
+
+
+    def put_object(self,bucket_folder,file_path, verbose=True,permission=None, mimetype=None,
+                   dedup=None):
+        '''upload_object will upload a file to path bucket_path in storage.
+        If dedup (default is the client's dedup), a file that already exists
+        with the same content is not uploaded, and the existing object returned.
         '''
-        return upload_file(storage_service=self.storage,
+        if dedup is None:
+            dedup = self.dedup
+        return upload_file(storage_service=self.get_storage(),
                            bucket=self.bucket,
                            mimetype=mimetype,
                            bucket_path=bucket_folder,
                            file_path=file_path,
                            permission=permission,
-                           verbose=verbose)
+                           verbose=verbose,
+                           dedup=dedup,
+                           index=self.hash_index,
+                           composite_threshold=self.composite_threshold,
+                           workers=self.composite_workers,
+                           journal=self.upload_journal,
+                           controller=self.controller)
+
+
+    def put_fileobj(self,bucket_folder,fileobj,file_name,verbose=True,permission=None,
+                    mimetype=None):
+        '''put_fileobj will upload an open file object (eg, an archive member)
+        to bucket_folder in storage, with object name the basename of file_name
+        '''
+        return upload_fileobj(storage_service=self.get_storage(),
+                              bucket=self.bucket,
+                              mimetype=mimetype,
+                              bucket_path=bucket_folder,
+                              fileobj=fileobj,
+                              file_name=file_name,
+                              permission=permission,
+                              verbose=verbose,
+                              controller=self.controller)
+
+
+    def list_objects(self, prefix=None, delimiter=None):
+        '''list_objects is a generator of the objects in the bucket, or
+        under a prefix (eg, Collection/X/Entity/Y/)
+        '''
+        return iter_bucket(bucket=self.bucket,
+                           storage_service=self.get_storage(),
+                           prefix=prefix,
+                           delimiter=delimiter)
+
+
+    def index_objects(self, index_file, prefix=None):
+        '''save a listing of the bucket (or prefix) to a local sqlite index,
+        to be searched with storage.utils.query_bucket_index
+        '''
+        return index_bucket(bucket=self.bucket,
+                            storage_service=self.get_storage(),
+                            index_file=index_file,
+                            prefix=prefix)
@@ -26,14 +26,45 @@ SOFTWARE.
 
 from googleapiclient.errors import HttpError
 from googleapiclient import http
+from som.api.google.utils import get_google_service
 from som.logger import bot
+from retrying import retry
 
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
+import base64
+import hashlib
 import httplib2
+import json
+import mmap
 import os
 import re
+import sqlite3
 import sys
 import tempfile
+import threading
+import time
+
+
+# Compose accepts at most 32 source objects, and parts are at least 32MB
+COMPOSE_MAX_PARTS = 32
+COMPOSITE_PART_SIZE = 32 * 1024 * 1024
+
+# Journaled (resumable) and throttled uploads send chunks of this size, so
+# at most one chunk is sent again when an upload is resumed, and bandwidth
+# is taken from the TrafficController one chunk at a time
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Throttled downloads of larger files are requested in ranges of this size
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Upload threads share the journal file
+_journal_lock = threading.Lock()
+
+# A batch request can have at most 100 calls, and failed calls with
+# these statuses are retried
+STORAGE_BATCH_SIZE = 100
+RETRY_STATUSES = [429, 500, 502, 503, 504]
 
     
 def get_bucket(storage_service,bucket_name):
@@ -56,7 +87,84 @@ def delete_object(storage_service,bucket_name,object_name):
     return operation
 
 
-def upload_file(storage_service,bucket,bucket_path,file_path,verbose=True,mimetype=None,permission=None):
+def delete_objects(storage_service,bucket_name,object_names,retries=3):
+    '''delete_objects will delete many objects from a bucket, with batch
+    requests of up to STORAGE_BATCH_SIZE calls. Returns a dictionary with
+    the result for each object name, an HttpError if the delete failed
+    (as for delete_object). See run_batch.
+    '''
+    objects = storage_service.objects()
+    calls = dict((name, lambda name=name: objects.delete(bucket=bucket_name,
+                                                         object=name))
+                 for name in object_names)
+    return run_batch(storage_service,calls,retries=retries)
+
+
+def get_objects(storage_service,bucket_name,object_names,fields=None,retries=3):
+    '''get_objects will get the metadata for many objects in a bucket, with
+    batch requests. Returns a dictionary with the metadata (or HttpError)
+    for each object name. See run_batch.
+    '''
+    objects = storage_service.objects()
+    kwargs = {'bucket': bucket_name}
+    if fields is not None:
+        kwargs['fields'] = fields
+    calls = dict((name, lambda name=name: objects.get(object=name, **kwargs))
+                 for name in object_names)
+    return run_batch(storage_service,calls,retries=retries)
+
+
+def patch_objects(storage_service,bucket_name,object_names,body,retries=3):
+    '''patch_objects will patch (update) many objects in a bucket with the
+    same body (eg, {"metadata": {...}}), with batch requests. Returns a
+    dictionary with the updated metadata (or HttpError) for each object
+    name. See run_batch.
+    '''
+    objects = storage_service.objects()
+    calls = dict((name, lambda name=name: objects.patch(bucket=bucket_name,
+                                                        object=name,
+                                                        body=body))
+                 for name in object_names)
+    return run_batch(storage_service,calls,retries=retries)
+
+
+def run_batch(storage_service,calls,retries=3):
+    '''run_batch will run many calls with batch requests of up to
+    STORAGE_BATCH_SIZE. Calls that fail with a status in RETRY_STATUSES are
+    retried (with exponential backoff) in a new batch, up to retries times.
+    :param calls: a dictionary of functions that return a request, by name
+    Returns a dictionary of the response (or HttpError) for each name.
+    '''
+    results = dict()
+    pending = list(calls)
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            bot.debug("Retrying %s failed batch calls." %len(pending))
+            time.sleep(2 ** attempt)
+
+        for start in range(0, len(pending), STORAGE_BATCH_SIZE):
+            names = pending[start:start + STORAGE_BATCH_SIZE]
+
+            def callback(request_id, response, exception, names=names):
+                name = names[int(request_id)]
+                results[name] = response if exception is None else exception
+
+            batch = storage_service.new_batch_http_request(callback=callback)
+            for i,name in enumerate(names):
+                batch.add(calls[name](), request_id=str(i))
+            batch.execute()
+
+        pending = [name for name in pending if isinstance(results[name], HttpError)
+                   and int(results[name].resp.status) in RETRY_STATUSES]
+        if not pending:
+            break
+
+    return results
+
+
+def upload_file(storage_service,bucket,bucket_path,file_path,verbose=True,mimetype=None,permission=None,
+                dedup=False,index=None,composite_threshold=None,workers=None,journal=None,
+                controller=None):
     '''get_folder will return the folder with folder_name, and if create=True,
     will create it if not found. If folder is found or created, the metadata is
     returned, otherwise None is returned
@@ -64,46 +172,678 @@ def upload_file(storage_service,bucket,bucket_path,file_path,verbose=True,mimety
     :param bucket: the bucket object from get_bucket
     :param file_path: the path to the file to upload
     :param bucket_path: the path to upload to
+    :param dedup: if True, don't upload a file that already exists in storage
+    with the same content (md5), and return the existing object instead
+    :param index: an optional index of local file hashes, see get_file_hash
+    :param composite_threshold: if defined, files larger than this many bytes
+    are uploaded in parts in parallel (with workers threads), see upload_composite
+    :param journal: if defined, a file to save upload session uris in, so
+    an interrupted upload is resumed instead of started again
+    :param controller: an optional TrafficController shared by uploads, to
+    limit bandwidth, requests, and concurrency
     '''
     if bucket_path[-1] != '/':
         bucket_path = "%s/" %(bucket_path)
     bucket_path = "%s%s" %(bucket_path,os.path.basename(file_path))
     body = {'name': bucket_path }
 
+    if dedup is True:
+        existing = get_unchanged_object(storage_service=storage_service,
+                                        bucket=bucket,
+                                        bucket_path=bucket_path,
+                                        file_path=file_path,
+                                        index=index)
+        if existing is not None:
+            bot.debug("%s is unchanged in storage, skipping upload." %bucket_path)
+            return existing
+
     if permission == None:
         permission = "publicRead"
 
     if mimetype == None:
         mimetype = sniff_extension(file_path,verbose=verbose)
+
+    if composite_threshold is not None:
+        if os.path.getsize(file_path) > composite_threshold:
+            return upload_composite(storage_service=storage_service,
+                                    bucket=bucket,
+                                    object_name=bucket_path,
+                                    file_path=file_path,
+                                    mimetype=mimetype,
+                                    permission=permission,
+                                    workers=workers,
+                                    controller=controller)
+
+    chunksize = http.DEFAULT_CHUNK_SIZE
+    if journal is not None or controller is not None:
+        chunksize = UPLOAD_CHUNK_SIZE
+
     media = http.MediaFileUpload(file_path,
                                  mimetype=mimetype,
+                                 chunksize=chunksize,
                                  resumable=True)
     try:
         request = storage_service.objects().insert(bucket=bucket['id'], 
                                                    body=body,
                                                    predefinedAcl=permission,
                                                    media_body=media)
-        result = request.execute()
-    except HttpError:
+        if journal is not None or controller is not None:
+            # The journal key is the local file's path, size and mtime, so
+            # the file is only hashed to check an upload that was resumed
+            key = None
+            if journal is not None:
+                stat = os.stat(file_path)
+                key = "%s/%s:%s:%s:%s" %(bucket['id'],
+                                         bucket_path,
+                                         os.path.abspath(file_path),
+                                         stat.st_size,
+                                         stat.st_mtime)
+            result = resumable_execute(request=request,
+                                       journal=journal,
+                                       key=key,
+                                       size=os.path.getsize(file_path),
+                                       controller=controller,
+                                       md5=lambda: get_file_hash(file_path,'md5',index))
+        else:
+            result = request.execute()
+    except HttpError as error:
+        bot.error("Error uploading %s: %s" %(bucket_path,error))
         result = None
-        pass
 
     return result
 
 
+def upload_fileobj(storage_service,bucket,bucket_path,fileobj,file_name,verbose=True,
+                   mimetype=None,permission=None,controller=None):
+    '''upload_fileobj will upload an open file object (eg, a member of a
+    compressed archive, see som.utils.iter_compressed) to storage, streaming
+    it in chunks so it's never written to disk or read fully into memory.
+    :param storage_service: the drive_service created from get_storage_service
+    :param bucket: the bucket object from get_bucket
+    :param bucket_path: the path (folder) to upload to
+    :param fileobj: the (seekable) file object to upload
+    :param file_name: the name of the file, the basename is the object name
+    :param controller: an optional TrafficController, see upload_file
+    '''
+    if bucket_path[-1] != '/':
+        bucket_path = "%s/" %(bucket_path)
+    bucket_path = "%s%s" %(bucket_path,os.path.basename(file_name))
+    body = {'name': bucket_path }
+
+    if permission == None:
+        permission = "publicRead"
+
+    if mimetype == None:
+        mimetype = sniff_extension(file_name,verbose=verbose)
+
+    media = http.MediaIoBaseUpload(fileobj,
+                                   mimetype=mimetype,
+                                   chunksize=UPLOAD_CHUNK_SIZE,
+                                   resumable=True)
+    try:
+        request = storage_service.objects().insert(bucket=bucket['id'],
+                                                   body=body,
+                                                   predefinedAcl=permission,
+                                                   media_body=media)
+        if controller is not None:
+            size = fileobj.seek(0, os.SEEK_END)
+            fileobj.seek(0)
+            result = resumable_execute(request=request,
+                                       size=size,
+                                       controller=controller)
+        else:
+            result = request.execute()
+    except HttpError as error:
+        bot.error("Error uploading %s: %s" %(bucket_path,error))
+        result = None
+
+    return result
+
+
+
+def get_unchanged_object(storage_service,bucket,bucket_path,file_path,index=None):
+    '''get_unchanged_object will return the metadata for the object at
+    bucket_path if it exists with the same size and hash as the local file,
+    and None otherwise. The md5 is used, or the crc32c if the object doesn't
+    have an md5 (composite objects). Only a metadata request is made, and the
+    file is only hashed if the sizes match.
+    :param bucket_path: the full name of the object in the bucket
+    :param index: an optional index of local file hashes, see get_file_hash
+    '''
+    try:
+        obj = storage_service.objects().get(bucket=bucket['id'],
+                                            object=bucket_path,
+                                            projection='full').execute()
+    except HttpError:
+        return None
+
+    if int(obj.get('size', -1)) != os.path.getsize(file_path):
+        return None
+
+    if obj.get('md5Hash') is not None:
+        if obj['md5Hash'] == get_file_hash(file_path,'md5',index):
+            return obj
+    elif obj.get('crc32c') is not None:
+        if obj['crc32c'] == get_file_hash(file_path,'crc32c',index):
+            return obj
+    return None
+
+
+#######################################################################
+# LISTING #############################################################
+#######################################################################
+
+# Only the fields needed to check uploads are requested when listing
+LIST_FIELDS = 'nextPageToken,prefixes,items(name,size,contentType,md5Hash,crc32c,updated)'
+
 
-def list_bucket(bucket,storage_service):
-    # Create a request to objects.list to retrieve a list of objects.        
-    request = storage_service.objects().list(bucket=bucket['id'], 
-                                             fields='nextPageToken,items(name,size,contentType)')
-    # Go through the request and look for the folder
-    objects = []
-    while request:
+def iter_bucket(bucket,storage_service,prefix=None,delimiter=None,fields=None,prefixes=False):
+    '''iter_bucket is a generator that lists the objects in a bucket, one
+    page at a time, following the nextPageToken until the listing is done.
+    :param prefix: only list objects with names that start with prefix
+    :param delimiter: eg "/", to not list objects in "subfolders" of prefix
+    :param fields: the fields to request (default LIST_FIELDS)
+    :param prefixes: if True, yield the prefixes ("subfolders", when a
+    delimiter is used) instead of the objects
+    '''
+    if fields is None:
+        fields = LIST_FIELDS
+
+    kwargs = {'bucket': bucket['id'], 'fields': fields}
+    if prefix is not None:
+        kwargs['prefix'] = prefix
+    if delimiter is not None:
+        kwargs['delimiter'] = delimiter
+
+    objects = storage_service.objects()
+    request = objects.list(**kwargs)
+    while request is not None:
         response = request.execute()
-        objects = objects + response['items']
-    return objects
+        if prefixes is True:
+            for name in response.get('prefixes', []):
+                yield name
+        else:
+            for item in response.get('items', []):
+                yield item
+        request = objects.list_next(request, response)
+
+
+def list_bucket(bucket,storage_service,prefix=None,delimiter=None):
+    '''list_bucket returns a list of all objects in the bucket (or under
+    prefix). See iter_bucket to not hold the listing in memory.
+    '''
+    return list(iter_bucket(bucket=bucket,
+                            storage_service=storage_service,
+                            prefix=prefix,
+                            delimiter=delimiter))
+
+
+def index_bucket(bucket,storage_service,index_file,prefix=None):
+    '''index_bucket will list the bucket (or objects under prefix) and save
+    the listing in a sqlite database index_file, replacing anything
+    previously indexed under the prefix. Use query_bucket_index to check
+    what is uploaded without listing the bucket again.
+    Returns the number of objects indexed.
+    '''
+    connection = get_bucket_index(index_file)
+    count = 0
+    with connection:
+        connection.execute('DELETE FROM objects WHERE name >= ? AND name < ?',
+                           get_prefix_range(prefix))
+        for item in iter_bucket(bucket,storage_service,prefix=prefix):
+            connection.execute('INSERT OR REPLACE INTO objects VALUES (?,?,?,?,?,?)',
+                               (item['name'],
+                                int(item.get('size', 0)),
+                                item.get('contentType'),
+                                item.get('md5Hash'),
+                                item.get('crc32c'),
+                                item.get('updated')))
+            count += 1
+    connection.close()
+    bot.debug("Indexed %s objects in %s" %(count,index_file))
+    return count
+
+
+def query_bucket_index(index_file,prefix=None):
+    '''query_bucket_index is a generator of the objects (dictionaries, with
+    the fields in LIST_FIELDS) saved by index_bucket with names that start
+    with prefix, eg "Collection/X/Entity/Y/"
+    '''
+    connection = get_bucket_index(index_file)
+    columns = ['name','size','contentType','md5Hash','crc32c','updated']
+    try:
+        rows = connection.execute('SELECT %s FROM objects WHERE name >= ? AND name < ? ORDER BY name' %','.join(columns),
+                                  get_prefix_range(prefix))
+        for row in rows:
+            yield dict(zip(columns,row))
+    finally:
+        connection.close()
+
+
+def get_bucket_index(index_file):
+    '''return a connection to the sqlite bucket index, creating it if needed'''
+    connection = sqlite3.connect(index_file)
+    connection.execute('''CREATE TABLE IF NOT EXISTS objects
+                          (name TEXT PRIMARY KEY, size INTEGER, contentType TEXT,
+                           md5Hash TEXT, crc32c TEXT, updated TEXT)''')
+    return connection
+
+
+def get_prefix_range(prefix=None):
+    '''return the (start, end) range of names that start with prefix,
+    so the index can be searched by primary key.
+    '''
+    if not prefix:
+        return ('', '\U0010ffff')
+    return (prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1))
 
 
+#######################################################################
+# THROTTLING ##########################################################
+#######################################################################
+
+# Responses that mean we are over quota (or storage is overloaded), and
+# concurrency should back off
+THROTTLE_STATUSES = [429, 503]
+
+
+class TrafficController(object):
+    '''a TrafficController is shared by threads that upload or download
+    from storage, to stay under a bytes per second and requests per second
+    limit (token buckets), and to adapt the number of concurrent requests.
+    Concurrency grows by one for each successful round of requests, and is
+    cut in half when storage responds with a 429 or 503 (AIMD).
+    :param bytes_per_second: the bandwidth limit, None for no limit
+    :param requests_per_second: the request limit, None for no limit
+    :param max_concurrency: the most concurrent requests (default 8)
+    :param min_concurrency: the fewest concurrent requests (default 1)
+    :param window: seconds of transfers to report throughput over
+    '''
+    def __init__(self, bytes_per_second=None, requests_per_second=None,
+                 max_concurrency=None, min_concurrency=None, window=10):
+        self.bytes_per_second = bytes_per_second
+        self.requests_per_second = requests_per_second
+        self.max_concurrency = max_concurrency or 8
+        self.min_concurrency = min(min_concurrency or 1, self.max_concurrency)
+        self.concurrency = float(self.max_concurrency)
+        self.active = 0
+        self.window = window
+
+        # Bucket levels, they go negative to wait out a large transfer
+        now = time.time()
+        self.byte_tokens = bytes_per_second or 0
+        self.request_tokens = requests_per_second or 0
+        self.updated = now
+
+        # (finished time, bytes) of recent transfers, for throughput
+        self.transfers = []
+        self.total_bytes = 0
+        self.total_requests = 0
+        self.throttled = 0
+        self.started = now
+        self.condition = threading.Condition()
+
+    def run(self, func, nbytes=0, *args, **kwargs):
+        '''run func(*args, **kwargs) when a slot is free, and after waiting
+        for nbytes and one request from the buckets. If func raises an
+        error with a throttle status, concurrency is decreased and the
+        request is retried (with exponential backoff) in the next free slot.
+        The error is raised when the retries are exhausted.
+        '''
+        return self._run_throttled(func, nbytes, *args, **kwargs)
+
+    @retry(retry_on_exception=lambda error: is_throttled(error),
+           wait_exponential_multiplier=1000,wait_exponential_max=10000,stop_max_attempt_number=5)
+    def _run_throttled(self, func, nbytes=0, *args, **kwargs):
+        self.acquire(nbytes)
+        try:
+            result = func(*args, **kwargs)
+        except Exception as error:
+            self.release(nbytes, get_error_status(error), success=False)
+            raise
+        self.release(nbytes)
+        return result
+
+    def acquire(self, nbytes=0):
+        '''wait for a free slot, and then for the bandwidth and request
+        budget for a transfer of nbytes.
+        '''
+        with self.condition:
+            while self.active >= int(self.concurrency):
+                self.condition.wait()
+            self.active += 1
+            wait = self._take(nbytes)
+        if wait > 0:
+            time.sleep(wait)
+
+    def release(self, nbytes=0, status=None, success=True):
+        '''release the slot taken with acquire, and adapt concurrency to
+        the result of the request (and its http status, if it failed).
+        '''
+        with self.condition:
+            self.active -= 1
+            if status in THROTTLE_STATUSES:
+                self.throttled += 1
+                self.concurrency = max(self.min_concurrency, self.concurrency / 2)
+                bot.debug("Storage returned %s, concurrency is now %s" %(status,
+                                                                       int(self.concurrency)))
+            elif success:
+                self.concurrency = min(self.max_concurrency,
+                                       self.concurrency + 1.0 / self.concurrency)
+                now = time.time()
+                self.transfers.append((now, nbytes))
+                self.total_bytes += nbytes
+                self.total_requests += 1
+                while self.transfers and self.transfers[0][0] < now - self.window:
+                    self.transfers.pop(0)
+            self.condition.notify_all()
+
+    def _take(self, nbytes):
+        '''refill the buckets, take nbytes and one request, and return the
+        seconds to wait until the buckets are no longer in debt. The
+        caller must hold the condition.
+        '''
+        now = time.time()
+        elapsed = now - self.updated
+        self.updated = now
+        wait = 0
+        if self.bytes_per_second:
+            self.byte_tokens = min(self.bytes_per_second,
+                                   self.byte_tokens + elapsed * self.bytes_per_second)
+            self.byte_tokens -= nbytes
+            if self.byte_tokens < 0:
+                wait = -self.byte_tokens / self.bytes_per_second
+        if self.requests_per_second:
+            self.request_tokens = min(self.requests_per_second,
+                                      self.request_tokens + elapsed * self.requests_per_second)
+            self.request_tokens -= 1
+            if self.request_tokens < 0:
+                wait = max(wait, -self.request_tokens / self.requests_per_second)
+        return wait
+
+    def throughput(self):
+        '''return the bytes per second transferred over the last window
+        seconds (or since starting, if shorter)
+        '''
+        with self.condition:
+            now = time.time()
+            nbytes = sum(size for finished,size in self.transfers
+                         if finished >= now - self.window)
+            seconds = min(self.window, now - self.started)
+        if seconds <= 0:
+            return 0.0
+        return nbytes / seconds
+
+    def stats(self):
+        '''return a dictionary of current throughput, concurrency, and totals'''
+        throughput = self.throughput()
+        with self.condition:
+            return {'bytes_per_second': throughput,
+                    'concurrency': int(self.concurrency),
+                    'active': self.active,
+                    'total_bytes': self.total_bytes,
+                    'total_requests': self.total_requests,
+                    'throttled': self.throttled}
+
+    def __str__(self):
+        stats = self.stats()
+        return "%.2f MB/s, %s requests (%s throttled), concurrency %s" %(stats['bytes_per_second'] / (1024 * 1024),
+                                                                     stats['total_requests'],
+                                                                     stats['throttled'],
+                                                                     stats['concurrency'])
+
+
+def is_throttled(error):
+    '''return True if the error is a 429 or 503 from storage'''
+    return get_error_status(error) in THROTTLE_STATUSES
+
+
+def get_error_status(error):
+    '''return the http status for an error from the discovery service
+    (HttpError) or google.cloud, or None if it doesn't have one.
+    '''
+    if isinstance(error, HttpError):
+        return int(error.resp.status)
+    status = getattr(error, 'code', None)
+    if isinstance(status, int):
+        return status
+    return None
+
+
+#######################################################################
+# RESUMABLE UPLOADS ###################################################
+#######################################################################
+
+
+def resumable_execute(request,journal=None,key=None,size=0,controller=None,md5=None):
+    '''resumable_execute will run a resumable upload request in chunks.
+    If a journal is given, the session uri is saved in it under key (the
+    bucket path, and path, size and mtime of the file). If the journal
+    already has a session for the key, the committed offset is looked up
+    and the upload continues from there. The entry is removed when the
+    upload is done. If a controller (TrafficController) is given, each
+    chunk is run with it, so bandwidth is used as the file is sent.
+    Returns the object, or None if a resumed upload doesn't match the md5.
+    :param md5: a function that returns the md5 of the file (as md5Hash),
+    only called to check an upload that was resumed
+    '''
+    uri = None
+    resumed = False
+    if journal is not None:
+        uri = read_upload_journal(journal).get(key)
+    if uri is not None:
+        offset,result = get_upload_offset(request.http, uri, size)
+        if result is not None:
+            update_upload_journal(journal, key)
+            return check_resumed_upload(result, md5)
+        if offset is not None:
+            bot.debug("Resuming upload of %s at byte %s" %(key, offset))
+            request.resumable_uri = uri
+            request.resumable_progress = offset
+            resumed = True
+
+    result = None
+    while result is None:
+        if controller is not None:
+            nbytes = min(request.resumable.chunksize(),
+                         size - request.resumable_progress)
+            status,result = controller.run(request.next_chunk, nbytes)
+        else:
+            status,result = request.next_chunk()
+        if journal is None:
+            continue
+        if request.resumable_uri is not None and request.resumable_uri != uri:
+            uri = request.resumable_uri
+            update_upload_journal(journal, key, uri)
+
+    if journal is not None:
+        update_upload_journal(journal, key)
+    if resumed:
+        return check_resumed_upload(result, md5)
+    return result
+
+
+def check_resumed_upload(result,md5=None):
+    '''return the object from a resumed upload, or None (and log an error)
+    if its md5 doesn't match the local file's, md5 a function to get it.
+    '''
+    if md5 is None or result.get('md5Hash') is None:
+        return result
+    if result['md5Hash'] != md5():
+        bot.error("Resumed upload of %s doesn't match the local file, upload it again." %result.get('name'))
+        return None
+    return result
+
+
+def get_upload_offset(http_client,uri,size):
+    '''get_upload_offset asks storage for the number of bytes committed
+    for an upload session. Returns a tuple (offset, result), where result
+    is the object if the upload is complete. If the session has expired
+    or is invalid, the offset is None.
+    '''
+    headers = {'Content-Range': 'bytes */%s' %size,
+               'Content-Length': '0'}
+    response,content = http_client.request(uri, method='PUT', body='', headers=headers)
+    status = int(response.status)
+    if status in [200, 201]:
+        return size, json.loads(content.decode('utf-8'))
+    if status == 308:
+        if 'range' in response:
+            return int(response['range'].split('-')[-1]) + 1, None
+        return 0, None
+    bot.debug("Upload session returned %s, starting again." %status)
+    return None, None
+
+
+def read_upload_journal(journal):
+    '''read the journal of upload sessions, a dictionary of session uris
+    by key. If the journal doesn't exist it is empty.
+    '''
+    with _journal_lock:
+        if not os.path.exists(journal):
+            return dict()
+        with open(journal,'r') as filey:
+            return json.load(filey)
+
+
+def update_upload_journal(journal,key,uri=None):
+    '''save the session uri for key in the journal, or remove key if
+    uri is None. The journal is written to a temporary file and then
+    moved, so it is never left partially written.
+    '''
+    with _journal_lock:
+        sessions = dict()
+        if os.path.exists(journal):
+            with open(journal,'r') as filey:
+                sessions = json.load(filey)
+        if uri is None:
+            sessions.pop(key, None)
+        else:
+            sessions[key] = uri
+        tmp_journal = "%s.tmp" %journal
+        with open(tmp_journal,'w') as filey:
+            json.dump(sessions,filey)
+        os.replace(tmp_journal,journal)
+
+
+#######################################################################
+# COMPOSITE UPLOADS ###################################################
+#######################################################################
+
+
+def upload_composite(storage_service,bucket,object_name,file_path,mimetype,permission,
+                     workers=None,part_size=None,controller=None):
+    '''upload_composite will upload a large file as parts, concurrently, from
+    memory mapped slices of the file, and then compose the parts into the
+    final object (object_name) in storage. The parts that were uploaded
+    are always deleted. Returns the metadata for the composed object, or
+    None on error (eg, if any part failed to upload).
+    :param workers: the number of threads to upload parts with (default 4)
+    :param part_size: the size of each part, adjusted up so there are
+    no more than COMPOSE_MAX_PARTS parts (default COMPOSITE_PART_SIZE)
+    :param controller: an optional TrafficController to upload parts with
+    '''
+    if workers is None:
+        workers = 4
+    if part_size is None:
+        part_size = COMPOSITE_PART_SIZE
+
+    size = os.path.getsize(file_path)
+    part_size = max(part_size, -(-size // COMPOSE_MAX_PARTS))
+    offsets = list(range(0, size, part_size))
+    part_names = ["%s.part-%02d" %(object_name,i) for i in range(len(offsets))]
+
+    def upload_part(part_name,offset):
+        # Services are not thread safe, each thread gets its own
+        service = get_google_service('storage', 'v1')
+        part = FileSlice(mapped, offset, min(part_size, size - offset))
+        chunksize = http.DEFAULT_CHUNK_SIZE
+        if controller is not None:
+            chunksize = UPLOAD_CHUNK_SIZE
+        media = http.MediaIoBaseUpload(part,
+                                       mimetype=mimetype,
+                                       chunksize=chunksize,
+                                       resumable=True)
+        request = service.objects().insert(bucket=bucket['id'],
+                                           body={'name': part_name},
+                                           media_body=media)
+        if controller is not None:
+            return resumable_execute(request=request,
+                                     size=part.length,
+                                     controller=controller)
+        return request.execute()
+
+    result = None
+    uploaded = []
+    with open(file_path,'rb') as filey:
+        mapped = mmap.mmap(filey.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            failed = 0
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [(name, executor.submit(upload_part, name, offset))
+                           for name,offset in zip(part_names, offsets)]
+                for name,future in futures:
+                    try:
+                        future.result()
+                        uploaded.append(name)
+                    except Exception as error:
+                        bot.error("Error uploading part %s: %s" %(name,error))
+                        failed += 1
+            if failed:
+                bot.error("%s of %s parts of %s failed to upload." %(failed,
+                                                                     len(part_names),
+                                                                     object_name))
+                return None
+
+            body = {'sourceObjects': [{'name': name} for name in part_names],
+                    'destination': {'contentType': mimetype}}
+            storage_service.objects().compose(destinationBucket=bucket['id'],
+                                              destinationObject=object_name,
+                                              destinationPredefinedAcl=permission,
+                                              body=body).execute()
+
+            # The full metadata (with owner) as returned by an upload
+            result = storage_service.objects().get(bucket=bucket['id'],
+                                                   object=object_name,
+                                                   projection='full').execute()
+        except HttpError as error:
+            bot.error("Error with composite upload of %s: %s" %(object_name,error))
+        finally:
+            mapped.close()
+            if uploaded:
+                delete_objects(storage_service, bucket['id'], uploaded)
+
+    return result
+
+
+class FileSlice(object):
+    '''a read only file-like object for length bytes of a memory mapped
+    file, starting at offset, to upload one part of a file.
+    '''
+    def __init__(self, mapped, offset, length):
+        self.mapped = mapped
+        self.offset = offset
+        self.length = length
+        self.position = 0
+
+    def seek(self, position, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            position += self.position
+        elif whence == os.SEEK_END:
+            position += self.length
+        self.position = min(max(position, 0), self.length)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.length - self.position
+        size = min(size, self.length - self.position)
+        start = self.offset + self.position
+        self.position += size
+        return self.mapped[start:start + size]
 
 
 #######################################################################
@@ -116,7 +856,7 @@ def get_storage_fields(obj):
     fields, to be saved as strings with a datastore object.
     '''                                   
     fields = {'storage_bucket':obj['bucket'],
-              'storage_md5Hash':obj['md5Hash'],
+              'storage_md5Hash':obj.get('md5Hash'), # not for composite objects
               'storage_updated':obj['updated'],
               'storage_download':obj['mediaLink'],
               'storage_metadataLink':obj['selfLink'],
@@ -147,6 +887,77 @@ def get_metadata(key):
     return None
 
 
+#######################################################################
+# HASHES ##############################################################
+#######################################################################
+
+# Files are hashed in blocks, so they are never read fully into memory
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def get_file_hash(file_path,hash_type="md5",index=None):
+    '''get_file_hash will return the base64 encoded md5 or crc32c of a
+    file, in the same format as md5Hash and crc32c of a storage object.
+    :param file_path: the path to the file to hash
+    :param hash_type: one of md5 (default) or crc32c (requires crcmod)
+    :param index: an optional dictionary (see read_hash_index) of hashes
+    by file path. A hash is reused if the file size and modification time
+    are unchanged, otherwise it is computed and the index updated.
+    '''
+    file_path = os.path.abspath(file_path)
+    stat = os.stat(file_path)
+    entry = None
+    if index is not None:
+        entry = index.get(file_path)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+            entry = {'size': stat.st_size, 'mtime': stat.st_mtime}
+            index[file_path] = entry
+        if hash_type in entry:
+            return entry[hash_type]
+
+    if hash_type == "md5":
+        hasher = hashlib.md5()
+    elif hash_type == "crc32c":
+        try:
+            import crcmod.predefined
+        except ImportError:
+            bot.error("crcmod must be installed to calculate crc32c.")
+            sys.exit(1)
+        hasher = crcmod.predefined.Crc('crc-32c')
+    else:
+        bot.error("%s is not a valid hash_type, choices are md5 or crc32c." %hash_type)
+        sys.exit(1)
+
+    with open(file_path,'rb') as filey:
+        for block in iter(lambda: filey.read(HASH_BLOCK_SIZE), b''):
+            hasher.update(block)
+
+    digest = base64.b64encode(hasher.digest()).decode('utf-8')
+    if entry is not None:
+        entry[hash_type] = digest
+    return digest
+
+
+def read_hash_index(index_file):
+    '''read a saved index of file hashes (see get_file_hash), returning
+    an empty index if the file doesn't exist or can't be read.
+    '''
+    if os.path.exists(index_file):
+        try:
+            with open(index_file,'r') as filey:
+                return json.load(filey)
+        except ValueError:
+            bot.warning("Hash index %s is invalid, starting a new one." %index_file)
+    return dict()
+
+
+def write_hash_index(index,index_file):
+    '''save an index of file hashes to index_file'''
+    with open(index_file,'w') as filey:
+        json.dump(index,filey)
+    return index_file
+
+
 #######################################################################
 # EXTENSIONS AND FILES ################################################
 #######################################################################
@@ -65,6 +65,8 @@ import shutil
 import simplejson
 import sys
 import tempfile
+import threading
+import importlib
 import time
 import zipfile
 
@@ -90,9 +92,49 @@ doretry = retry(wait_exponential_multiplier=1000,wait_exponential_max=10000,stop
 # GOOGLE GENERAL API ##################################################
 #######################################################################
 
+# Process wide registry of credentials, discovery documents, and clients.
+# Discovery services use httplib2, which is not thread safe, so they are
+# built (from the shared document) once per thread. google.cloud clients
+# are shared by all threads.
+
+_registry = {'credentials': None,
+             'documents': dict(),
+             'clients': dict()}
+
+_registry_lock = threading.RLock()
+_services = threading.local()
+
+
+def get_credentials():
+    '''get_credentials returns the application default credentials,
+    looked up once per process.
+    '''
+    with _registry_lock:
+        if _registry['credentials'] is None:
+            _registry['credentials'] = GoogleCredentials.get_application_default()
+        return _registry['credentials']
+
+
+@doretry
+def get_discovery_document(service_type,version):
+    '''get_discovery_document returns the discovery document (json string)
+    for a service and version, retrieved once per process.
+    '''
+    key = (service_type, version)
+    with _registry_lock:
+        if key not in _registry['documents']:
+            url = discovery.DISCOVERY_URI.format(api=service_type,
+                                                 apiVersion=version)
+            response = requests.get(url)
+            response.raise_for_status()
+            _registry['documents'][key] = response.text
+        return _registry['documents'][key]
+
+
 def get_google_service(service_type=None,version=None):
     '''
-    get_url will use the requests library to get a url
+    get_google_service returns a discovery service for the calling thread,
+    built from the shared discovery document and credentials.
     :param service_type: the service to get (default is storage)
     :param version: version to use (default is v1)
     '''
@@ -101,9 +143,30 @@ def get_google_service(service_type=None,version=None):
     if version == None:
         version = "v1"
 
-    credentials = GoogleCredentials.get_application_default()
-    return discovery.build(service_type, version, credentials=credentials) 
+    key = (service_type, version)
+    services = getattr(_services, 'services', None)
+    if services is None:
+        services = _services.services = dict()
 
+    if key not in services:
+        document = get_discovery_document(service_type, version)
+        services[key] = discovery.build_from_document(document,
+                                                      credentials=get_credentials())
+    return services[key]
+
+
+def get_cloud_client(service_type,project=None):
+    '''get_cloud_client returns a google.cloud client (eg, datastore,
+    bigquery, storage) for a project, shared across the process.
+    :param service_type: the google.cloud module with the Client
+    :param project: the project, None to use the default project
+    '''
+    key = (service_type, project)
+    with _registry_lock:
+        if key not in _registry['clients']:
+            module = importlib.import_module('google.cloud.%s' %service_type)
+            _registry['clients'][key] = module.Client(project=project)
+        return _registry['clients'][key]
 
 
 #######################################################################
@@ -75,6 +75,14 @@ def get_parser():
                     help="one or more filters, in key,operator,value PatientSex,=,F", 
                     type=str, default=None)
 
+    ls.add_argument("--collection", dest='collection', 
+                    help="summarize counts for only this collection (eg, IRB33192)", 
+                    type=str, default=None)
+
+    ls.add_argument("--by-collection", dest='by_collection', 
+                    help="summarize counts for each collection", 
+                    default=False, action='store_true')
+
     # Get (download)
     get = subparsers.add_parser("get", 
                                 help="download data from storge and datastore")
@@ -104,6 +112,26 @@ def get_parser():
     get.add_argument("--collection", dest='collection', 
                      help="name of collection (eg, IRB33192)", 
                      type=str, required=True)
+
+    get.add_argument("--workers", dest='workers', 
+                     help="number of parallel downloads (default 1)", 
+                     type=int, default=None)
+
+    get.add_argument("--chunk-size", dest='chunk_size', 
+                     help="download images larger than this many MB in parallel ranges", 
+                     type=int, default=None)
+
+    get.add_argument("--sync", dest='sync', 
+                     help="only download images that are missing or changed (by checksum)", 
+                     default=False, action='store_true')
+
+    get.add_argument("--bandwidth", dest='bandwidth', 
+                     help="limit downloads to this many MB per second", 
+                     type=float, default=None)
+
+    get.add_argument("--rate", dest='rate', 
+                     help="limit downloads to this many requests per second", 
+                     type=float, default=None)
     
 
     return parser
@@ -170,17 +198,30 @@ def main():
                          filters=filters)
             sys.exit(0)
         from .search import summary
-        summary(project=args.project)
+        summary(project=args.project,
+                collection=args.collection,
+                group=args.by_collection)
         sys.exit(0)
 
     if args.command == "get":
         from .get import download_collection 
+        chunk_size = args.chunk_size
+        if chunk_size is not None:
+            chunk_size = chunk_size * 1024 * 1024
+        bandwidth = args.bandwidth
+        if bandwidth is not None:
+            bandwidth = bandwidth * 1024 * 1024
         output_folder = download_collection(output_folder=args.outfolder,
                                             collection=args.collection,
                                             project=args.project,
                                             suid=args.suid,
                                             query_entity=not args.query_images,
-                                            bucket=args.bucket)
+                                            bucket=args.bucket,
+                                            workers=args.workers,
+                                            chunk_size=chunk_size,
+                                            sync=args.sync,
+                                            bandwidth=bandwidth,
+                                            rate=args.rate)
         sys.exit(0)
 
     parser.print_help()
@@ -27,14 +27,33 @@ from som.logger import bot
 
 from google.cloud.exceptions import Forbidden
 from google.auth.exceptions import DefaultCredentialsError
-from google.cloud import storage
+from som.api.google.utils import get_cloud_client
+from som.api.google.storage.utils import (
+    TrafficController,
+    get_file_hash,
+    read_hash_index,
+    write_hash_index
+)
 from som.cli.requester import RetryRequester
 
+from concurrent.futures import (
+    ThreadPoolExecutor,
+    as_completed
+)
+import json
 import tempfile
 import os
 import sys
 
 
+# The manifest records completed downloads, one json object per line,
+# so an interrupted download can be resumed
+MANIFEST_NAME = '.som-manifest'
+
+# For sync, the hashes of local files are cached, by size and modified time
+HASH_INDEX_NAME = '.som-hashes'
+
+
 
 try:
     from urllib.request import urlopen, Request
@@ -50,7 +69,12 @@ def progress_download(collection_name,
                       project,
                       bucket_name,
                       query_entity=True,
-                      filters=None):
+                      filters=None,
+                      workers=None,
+                      chunk_size=None,
+                      sync=False,
+                      bandwidth=None,
+                      rate=None):
 
     '''
     show progress while downloading images for a Collection/[c]/Entity/study 
@@ -73,6 +97,24 @@ def progress_download(collection_name,
 
     to retrieve all Image items that are equal to the study name
 
+    workers: the number of threads to download with (default 1)
+    chunk_size: if defined, images larger than chunk_size bytes are 
+                downloaded in ranges of this size, in parallel.
+
+    Images already recorded in the manifest (MANIFEST_NAME) in the 
+    output_folder are not downloaded again.
+
+    sync: instead of the manifest, compare local files to the md5 (or
+          crc32c) saved with each image in Datastore, and only download
+          images that are missing or changed. Hashes of local files are
+          cached in HASH_INDEX_NAME in the output_folder.
+
+    bandwidth: if defined, download at most this many bytes per second
+    rate: if defined, make at most this many download requests per second
+
+    The workers are the most concurrent downloads, and this is reduced
+    (and then slowly increased again) when storage responds with 429 or 503.
+
     Returns
     =======
     path to newly created image file
@@ -88,7 +130,7 @@ def progress_download(collection_name,
     bot.info("Collecting available images...")
 
     try:
-        storage_client = storage.Client()
+        storage_client = get_cloud_client('storage')
 
     except DefaultCredentialsError:
         bot.error("We didn't detect your GOOGLE_APPLICATION_CREDENTIALS in the environment! Did you export the path?")
@@ -111,44 +153,214 @@ def progress_download(collection_name,
     if query_entity is True:
         entity_set = requester.get_entity(filters)
         images = []
+        seen = set()
         for entity in entity_set:
             entity_images = requester.client.get_images(entity=entity)
-            images = [x for x in entity_images if x not in images]
+            for image in entity_images or []:
+                if image.key not in seen:
+                    seen.add(image.key)
+                    images.append(image)
     else:
-        images = requester.get_images(filters)
+        images = requester.get_image(filters)
     
     bot.info("Found %s images for suid %s in collection %s" %(len(images),
                                                              suid,
                                                              collection_name))
     
+    manifest_file = "%s/%s" %(output_folder, MANIFEST_NAME)
+    completed = read_manifest(manifest_file)
+
+    index_file = "%s/%s" %(output_folder, HASH_INDEX_NAME)
+    index = None
+    if sync is True:
+        index = read_hash_index(index_file)
+
     progress = 0
     total = len(images)
 
     files = []
-    if len(images) > 0:
-        bot.debug("Saving images and metadata...")
-        for image in images:
-
-            # Download image
-            file_name = prepare_folders(output_folder=output_folder,
-                                        image_name=image.key.name)
-            
-            blob = bucket.blob(image['storage_name'])
+
+    # The hash index is saved even if the download is interrupted, so
+    # files hashed so far don't need to be hashed again
+    try:
+        if len(images) > 0:
+            bot.debug("Saving images and metadata...")
             bot.show_progress(progress, total, length=35)
-            requester.download(blob,file_name)
-            files.append(file_name)
-            files.append(save_metadata(image,file_name))
-            progress+=1
-            bot.show_progress(progress,total,length=35)
 
-        # Newline to finish
-        sys.stdout.write('\n')
+            # Each part is (image, file_name, start, end), one or more per image
+            parts = []
+            remaining = dict()
+            for image in images:
+                file_name = prepare_folders(output_folder=output_folder,
+                                            image_name=image.key.name)
+
+                if sync is True:
+                    if is_unchanged(image, file_name, index):
+                        files.extend([file_name, save_metadata(image,file_name)])
+                        progress+=1
+                        bot.show_progress(progress,total,length=35)
+                        continue
+                else:
+                    entry = completed.get(image['storage_name'])
+                    if entry is not None and os.path.exists(entry['file']):
+                        files.extend([entry['file'], entry['metadata']])
+                        progress+=1
+                        bot.show_progress(progress,total,length=35)
+                        continue
+
+                image_parts = get_download_parts(image, file_name, chunk_size)
+                remaining[file_name] = len(image_parts)
+                parts.extend(image_parts)
+
+            if workers is None:
+                workers = 1
+
+            controller = TrafficController(bytes_per_second=bandwidth,
+                                           requests_per_second=rate,
+                                           max_concurrency=workers)
+
+            # Images with a part that failed (after retries), by file name
+            failed = dict()
+
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = dict((executor.submit(download_part, requester, bucket, *part,
+                                                controller=controller), part)
+                               for part in parts)
+
+                # Images are finished (metadata, manifest) here, with their last part
+                for future in as_completed(futures):
+                    image,file_name = futures[future][:2]
+                    try:
+                        future.result()
+                    except Exception as error:
+                        if file_name not in failed:
+                            bot.error("Error downloading %s: %s" %(image['storage_name'], error))
+                        failed[file_name] = image
+                    remaining[file_name] -= 1
+                    if remaining[file_name] > 0 or file_name in failed:
+                        continue
+                    metadata_file = save_metadata(image,file_name)
+                    update_manifest(manifest_file,{'storage_name': image['storage_name'],
+                                                   'file': file_name,
+                                                   'metadata': metadata_file})
+                    files.extend([file_name, metadata_file])
+                    if index is not None:
+                        add_to_index(image, file_name, index)
+                    progress+=1
+                    bot.show_progress(progress,total,length=35)
+
+            # Newline to finish
+            sys.stdout.write('\n')
+            if parts:
+                bot.info("Downloaded %s" %controller)
+            if failed:
+                bot.error("%s images failed to download, run again to retry:" %len(failed))
+                for image in failed.values():
+                    bot.error(image['storage_name'])
+
+    finally:
+        if index is not None:
+            write_hash_index(index, index_file)
 
     return files
 
 
-     
-       
+
+def get_download_parts(image, file_name, chunk_size=None):
+    '''get_download_parts returns a list of (image, file_name, start, end)
+    to download an image. Without a chunk_size, or if the image is not
+    larger than it, the whole image is one part (start and end None).
+    Otherwise, the file is created at full size, and one part is returned
+    for each range of chunk_size bytes.
+    '''
+    size = int(image.get('storage_size', 0))
+    if chunk_size is None or size <= chunk_size:
+        return [(image, file_name, None, None)]
+
+    with open(file_name, 'wb') as filey:
+        filey.truncate(size)
+
+    return [(image, file_name, start, min(start + chunk_size, size) - 1)
+            for start in range(0, size, chunk_size)]
+
+
+
+def download_part(requester, bucket, image, file_name, start=None, end=None,
+                  controller=None):
+    '''download_part will download an image, or the range of bytes
+    start to end (inclusive) of it into the (already created) file_name.
+    If a controller (TrafficController) is given, downloads are throttled
+    with it. Returns the image and file name.
+    '''
+    blob = bucket.blob(image['storage_name'])
+    if start is None:
+        requester.download(blob,file_name,
+                           controller=controller,
+                           size=int(image.get('storage_size', 0)))
+    else:
+        content = requester.download_range(blob,start,end,controller=controller)
+        with open(file_name, 'r+b') as filey:
+            filey.seek(start)
+            filey.write(content)
+    return image,file_name
+
+
+
+def is_unchanged(image, file_name, index=None):
+    '''is_unchanged returns True if file_name exists, and has the same size
+    and hash as the image in storage. The md5 is used, or the crc32c if the
+    image doesn't have an md5 (composite objects).
+    '''
+    if not os.path.exists(file_name):
+        return False
+    if int(image.get('storage_size', -1)) != os.path.getsize(file_name):
+        return False
+
+    if image.get('storage_md5Hash') is not None:
+        return image['storage_md5Hash'] == get_file_hash(file_name, 'md5', index)
+    if image.get('storage_crc32c') is not None:
+        return image['storage_crc32c'] == get_file_hash(file_name, 'crc32c', index)
+    return False
+
+
+
+def add_to_index(image, file_name, index):
+    '''add the hashes of a downloaded image to the hash index, so the
+    file doesn't need to be hashed on the next sync.
+    '''
+    stat = os.stat(file_name)
+    entry = {'size': stat.st_size, 'mtime': stat.st_mtime}
+    if image.get('storage_md5Hash') is not None:
+        entry['md5'] = image['storage_md5Hash']
+    if image.get('storage_crc32c') is not None:
+        entry['crc32c'] = image['storage_crc32c']
+    index[os.path.abspath(file_name)] = entry
+
+
+
+def read_manifest(manifest_file):
+    '''read the manifest of completed downloads, returning a dictionary
+    of entries keyed by storage_name. If it doesn't exist, it is empty.
+    '''
+    completed = dict()
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as filey:
+            for line in filey:
+                line = line.strip()
+                if line:
+                    entry = json.loads(line)
+                    completed[entry['storage_name']] = entry
+    return completed
+
+
+
+def update_manifest(manifest_file, entry):
+    '''add an entry (a completed download) to the manifest'''
+    with open(manifest_file, 'a') as filey:
+        filey.write("%s\n" %json.dumps(entry))
+
+
+
 def save_metadata(image,file_name):
     '''
     save the image metadata to json "file_name", removing the created
@@ -184,7 +396,7 @@ def prepare_folders(output_folder,image_name):
     for folder in folders:
         output_folder = "%s/%s" %(output_folder,folder)
         if not os.path.exists(output_folder):
-            os.mkdir(output_folder)
+            os.makedirs(output_folder, exist_ok=True)
  
     return "%s/%s" %(output_folder,image_name)
 
@@ -196,7 +408,12 @@ def download_collection(collection,
                         bucket,
                         query_entity=True,
                         output_folder=None,
-                        filters=None):
+                        filters=None,
+                        workers=None,
+                        chunk_size=None,
+                        sync=False,
+                        bandwidth=None,
+                        rate=None):
 
     '''
     client function to download a collection in entirety, intended for
@@ -219,4 +436,9 @@ def download_collection(collection,
                              project=project,
                              query_entity=query_entity,
                              bucket_name=bucket,
-                             filters=filters)
+                             filters=filters,
+                             workers=workers,
+                             chunk_size=chunk_size,
+                             sync=sync,
+                             bandwidth=bandwidth,
+                             rate=rate)
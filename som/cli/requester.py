@@ -23,6 +23,7 @@ SOFTWARE.
 '''
 
 from som.api.google.datastore import DataStoreClient as Client
+from som.api.google.storage.utils import DOWNLOAD_CHUNK_SIZE
 from retrying import retry
 
 ########################################################################
@@ -74,6 +75,31 @@ class RetryRequester:
         return self.client.batch.query(kind=kind,
                                        filters=filters)
 
+    # Iterate (stream) -----------------------------------------------------------------------------
+    # Pages are retried by the batch manager, so these generators are not wrapped
+
+    def iter_collection(self, filters=None):
+        return self.iter('Collection', filters)
+
+    def iter_entity(self, filters=None):
+        return self.iter('Entity', filters)
+
+    def iter_image(self, filters=None):
+        return self.iter('Image', filters)
+
+    def iter(self, kind, filters=None, start_cursor=None):
+        return self.client.batch.iter_query(kind=kind,
+                                            filters=filters,
+                                            start_cursor=start_cursor)
+
+    # Count ----------------------------------------------------------------------------------------
+
+    def count(self, kind, filters=None, ancestor=None, group_by=None):
+        return self.client.batch.count(kind=kind,
+                                       filters=filters,
+                                       ancestor=ancestor,
+                                       group_by=group_by)
+
     @retry(wait_exponential_multiplier=1000, wait_exponential_max=10000,stop_max_attempt_number=5)
     def get_client(self, bucket_name, project):
         self.client = Client(bucket_name=bucket_name,
@@ -83,5 +109,24 @@ class RetryRequester:
     # Download ----------------------------------------------------------------------------------------
 
     @retry(wait_exponential_multiplier=1000, wait_exponential_max=10000,stop_max_attempt_number=5)
-    def download(self, blob, file_name):
+    def download(self, blob, file_name, controller=None, size=0):
+        # Large files are downloaded in ranges, so bandwidth is taken
+        # from the controller as the file arrives
+        if controller is not None and size > DOWNLOAD_CHUNK_SIZE:
+            with open(file_name, 'wb') as filey:
+                for start in range(0, size, DOWNLOAD_CHUNK_SIZE):
+                    end = min(start + DOWNLOAD_CHUNK_SIZE, size) - 1
+                    filey.write(controller.run(blob.download_as_string,
+                                               end - start + 1,
+                                               start=start, end=end))
+            return
+        if controller is not None:
+            return controller.run(blob.download_to_filename, size, file_name)
         blob.download_to_filename(file_name)
+
+    @retry(wait_exponential_multiplier=1000, wait_exponential_max=10000,stop_max_attempt_number=5)
+    def download_range(self, blob, start, end, controller=None):
+        if controller is not None:
+            return controller.run(blob.download_as_string, end - start + 1,
+                                  start=start, end=end)
+        return blob.download_as_string(start=start, end=end)
@@ -35,21 +35,46 @@ except ImportError:
     from urllib2 import urlopen, Request
 
 
-def summary(project):
+def summary(project, collection=None, group=False):
     '''summarize counts of collections, images, entities
-    for a project'''
+    for a project. Counts use keys only queries, so no entities are
+    downloaded.
+
+    Parameters
+    ==========
+    project: the project name to search Datastore for. 
+    collection: if specified, only count under this collection
+    group: if True, show counts for each collection
+    '''
+
+    ancestor = None
+    if collection is not None:
+        ancestor = ['Collection', collection]
+
+    group_by = None
+    if group is True:
+        group_by = 'Collection'
 
     bot.spinner.start()
     requester = RetryRequester(project=project)
-    collections = requester.get_collection()
-    images = requester.get_image()
-    entities = requester.get_entity()
+    collections = requester.count('Collection', ancestor=ancestor)
+    images = requester.count('Image', ancestor=ancestor, group_by=group_by)
+    entities = requester.count('Entity', ancestor=ancestor, group_by=group_by)
     bot.spinner.stop()
     bot.newline()
 
-    bot.info('Collections: %s' %len(collections))
-    bot.info('Images: %s' %len(images))
-    bot.info('Entity: %s' %len(entities))
+    bot.info('Collections: %s' %collections)
+    if group_by is None:
+        bot.info('Images: %s' %images)
+        bot.info('Entity: %s' %entities)
+        return
+
+    for name in sorted(set(images) | set(entities)):
+        bot.custom(prefix=name, 
+                   message='Images: %s Entity: %s' %(images.get(name, 0),
+                                                     entities.get(name, 0)))
+    bot.info('Images: %s' %sum(images.values()))
+    bot.info('Entity: %s' %sum(entities.values()))
 
 
 def search_collections(project, uid=None):
@@ -93,17 +118,15 @@ def search_entity(project, filters=None):
     filters: fields to filter the entity
     '''
 
-    bot.spinner.start()
     requester = RetryRequester(project=project)
-    entities = requester.get_entity(filters=filters)
-    bot.spinner.stop()
-    bot.newline()
-    for entity in entities:
+    count = 0
+    for entity in requester.iter_entity(filters=filters):
         bot.info('Entity: %s' %entity['uid'])
         for key,val in entity.items():
             bot.custom(prefix=key, message=val)
         bot.newline()
-    bot.info("Found %s entities" %len(entities))
+        count += 1
+    bot.info("Found %s entities" %count)
 
 
 
@@ -117,13 +140,13 @@ def search_image(project, filters=None):
     '''
 
     requester = RetryRequester(project=project)
-    images = requester.get_image(filters=filters)
-
-    for image in images:
+    count = 0
+    for image in requester.iter_image(filters=filters):
         bot.info('Image: %s' %image['uid'])
         for key,val in image.items():
             bot.custom(prefix=key, message=val)
         bot.newline()
+        count += 1
 
-    bot.info("Found %s images" %len(images))
+    bot.info("Found %s images" %count)
 
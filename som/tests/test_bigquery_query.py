@@ -0,0 +1,108 @@
+'''
+test_bigquery_query.py: test paging through BigQuery query results
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+'''
+
+import unittest
+
+
+class Field(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class Iterator(object):
+    '''a stub of the iterator from QueryResults.fetch_data, with one page
+    of rows for a page token, and the token of the next page'''
+    def __init__(self, page, next_page_token):
+        self.page = page
+        self.next_page_token = next_page_token
+
+    @property
+    def pages(self):
+        return iter([self.page])
+
+
+class Results(object):
+    '''a stub of QueryResults, with pages of rows keyed by page token.
+    The schema is only set when the first page is fetched, as by the client.'''
+    def __init__(self, pages):
+        self.pages = pages
+        self.schema = []
+        self.calls = []
+
+    def fetch_data(self, max_results=None, page_token=None):
+        self.calls.append((max_results, page_token))
+        self.schema = [Field('Modality'), Field('Count')]
+        page, token = self.pages[page_token]
+        return Iterator(page[:max_results], token)
+
+
+class TestBigQueryQuery(unittest.TestCase):
+
+    def setUp(self):
+        try:
+            from som.api.google.bigquery import utils
+        except ImportError:
+            self.skipTest("google-cloud-bigquery is not installed")
+        self.utils = utils
+        self.results = Results({None: ([('CT', 1), ('MR', 2)], 'page2'),
+                                'page2': ([('CT', 3), ('US', 4)], 'page3'),
+                                'page3': ([('XA', 5)], None)})
+
+    def test_pages(self):
+        '''pages are fetched (page_size rows each) until there is no token'''
+        pages = list(self.utils.iter_result_pages(self.results, page_size=2))
+        self.assertEqual(len(pages), 3)
+        self.assertEqual(pages[0][0], ['Modality', 'Count'])
+        self.assertEqual(self.results.calls, [(2, None), (2, 'page2'), (2, 'page3')])
+        rows = list(self.utils.iter_result_rows(iter(pages)))
+        self.assertEqual([row['Count'] for row in rows], [1, 2, 3, 4, 5])
+
+    def test_arrow(self):
+        '''the arrow schema is read from the results after the first page'''
+        try:
+            import pyarrow
+        except ImportError:
+            self.skipTest("pyarrow is not installed")
+
+        self.results.schema = []
+        self.results.pages[None] = ([('CT', None)], None)
+        fields = [self.utils.bigquery.SchemaField('Modality', 'STRING'),
+                  self.utils.bigquery.SchemaField('Count', 'INTEGER')]
+        fetch_data = self.results.fetch_data
+        def fetch_typed(*args, **kwargs):
+            iterator = fetch_data(*args, **kwargs)
+            self.results.schema = fields
+            return iterator
+        self.results.fetch_data = fetch_typed
+
+        pages = self.utils.iter_result_pages(self.results, page_size=2)
+        table = self.utils.get_result_columns(pages, output="arrow",
+                                              results=self.results)
+        self.assertEqual(table.num_rows, 1)
+        self.assertEqual(table.schema.field('Count').type, pyarrow.int64())
+
+
+if __name__ == '__main__':
+    unittest.main()
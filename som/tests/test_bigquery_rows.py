@@ -0,0 +1,109 @@
+'''
+test_bigquery_rows.py: test encoding and writing rows for BigQuery load jobs
+
+Copyright (c) 2017 Vanessa Sochat
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+'''
+
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class TestBigQueryRows(unittest.TestCase):
+
+    def setUp(self):
+        try:
+            from google.cloud import bigquery
+            from som.api.google.bigquery import utils
+        except ImportError:
+            self.skipTest("google-cloud-bigquery is not installed")
+        self.bigquery = bigquery
+        self.utils = utils
+        self.tmpdir = tempfile.mkdtemp()
+        self.schema = [bigquery.SchemaField('Modality', 'STRING'),
+                       bigquery.SchemaField('StudyDate', 'TIMESTAMP'),
+                       bigquery.SchemaField('BirthDate', 'DATE')]
+        rows = [{'Modality': 'CT',
+                 'StudyDate': datetime.datetime(2017, 1, 1),
+                 'BirthDate': datetime.date(1961, 8, 1)},
+                {'Modality': 'MR',
+                 'StudyDate': '2017-01-01T00:00:00',
+                 'BirthDate': '1961-08-01'}]
+        self.rows = utils.RowEncoder(self.schema).encode_rows(rows)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_write_avro(self):
+        '''timestamp and date values (objects or strings) round trip avro'''
+        try:
+            import fastavro
+        except ImportError:
+            self.skipTest("fastavro is not installed")
+
+        file_name = os.path.join(self.tmpdir, 'rows.avro')
+        count = self.utils.write_rows(iter(self.rows), file_name,
+                                      self.schema, source_format="avro")
+        self.assertEqual(count, 2)
+        with open(file_name, 'rb') as filey:
+            records = list(fastavro.reader(filey))
+        self.assertEqual([x['Modality'] for x in records], ['CT', 'MR'])
+        for record in records:
+            self.assertEqual(record['StudyDate'].replace(tzinfo=None),
+                             datetime.datetime(2017, 1, 1))
+            self.assertEqual(record['BirthDate'], datetime.date(1961, 8, 1))
+
+    def test_write_json(self):
+        '''timestamp and date values are written to json in iso format'''
+        file_name = os.path.join(self.tmpdir, 'rows.json')
+        self.utils.write_rows(iter(self.rows), file_name, self.schema)
+        with open(file_name, 'r') as filey:
+            records = [json.loads(line) for line in filey]
+        self.assertEqual(records[0]['StudyDate'], '2017-01-01T00:00:00')
+        self.assertEqual(records[0]['BirthDate'], '1961-08-01')
+
+    def test_date_from_datetime(self):
+        '''a datetime for a DATE field is written as a date'''
+        rows = self.utils.RowEncoder(self.schema).encode_rows([{
+                   'BirthDate': datetime.datetime(1961, 8, 1, 12, 30)}])
+        self.assertEqual(rows[0][2], datetime.date(1961, 8, 1))
+        file_name = os.path.join(self.tmpdir, 'dates.json')
+        self.utils.write_rows(iter(rows), file_name, self.schema)
+        with open(file_name, 'r') as filey:
+            self.assertEqual(json.loads(filey.readline())['BirthDate'], '1961-08-01')
+
+    def test_parse_timestamp(self):
+        '''timestamps with a Z or utc offset are parsed to utc'''
+        parse = self.utils.parse_timestamp
+        expected = datetime.datetime(2017, 1, 1, 0, 0)
+        self.assertEqual(parse('2017-01-01T00:00:00Z'), expected)
+        self.assertEqual(parse('2017-01-01T00:00:00+00:00'), expected)
+        self.assertEqual(parse('2017-01-01T05:30:00+05:30'), expected)
+        self.assertEqual(parse('2016-12-31 19:00:00.000000-0500'), expected)
+        self.assertEqual(parse('2017-01-01'), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
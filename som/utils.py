@@ -245,3 +245,41 @@ def untar_dir(tar_file,dest_dir=None):
         with tarfile.open(tar_file) as tf:
             tf.extractall(dest_dir)
     return dest_dir
+
+
+
+def get_member_name(name):
+    '''get_member_name returns the name of a member of an archive without
+    a leading ./ or /, so "./collection/entity.json" (from tar czf x.tar.gz
+    ./collection) is "collection/entity.json".
+    '''
+    while name.startswith('./'):
+        name = name[2:]
+    return name.lstrip('/')
+
+
+def iter_compressed(compressed_file):
+    '''iter_compressed is a generator of the files in a .zip or .tar.gz,
+    without extracting them. Each is a tuple (name, fileobj), where
+    fileobj is a (seekable) file like object for the member, only valid
+    until the next member is read. Names are relative (see get_member_name),
+    and directories are skipped.
+    :param compressed_file: the .zip or .tar.gz file to read
+    '''
+    if compressed_file.endswith('.zip'):
+        with zipfile.ZipFile(compressed_file,"r") as zf:
+            for info in zf.infolist():
+                name = get_member_name(info.filename)
+                if name and not info.filename.endswith('/'):
+                    with zf.open(info) as fileobj:
+                        yield name, fileobj
+
+    elif tarfile.is_tarfile(compressed_file):
+        with tarfile.open(compressed_file) as tf:
+            for member in tf:
+                name = get_member_name(member.name)
+                if name and member.isfile():
+                    yield name, tf.extractfile(member)
+
+    else:
+        bot.error("Invalid compressed file type: %s" %compressed_file)
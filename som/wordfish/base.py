@@ -14,7 +14,9 @@ from som.utils import (
 )
 
 from som.wordfish.validators import (
-    validate_dataset
+    validate_compressed,
+    validate_dataset,
+    validate_folder
 )
 
 from som.wordfish.structures import (
@@ -65,9 +67,7 @@ def run_validation(inputs,test_dir=None,clean_up=True,fail_exit=True):
         if os.path.isdir(testing):
             valid = validate_folder(folder=testing)
         elif re.search("[.]zip$|[.]tar[.]gz$",testing):
-            valid = validate_compressed(compressed_file=testing,
-                                        testing_base=test_dir,
-                                        clean_up=clean_up)
+            valid = validate_compressed(compressed_file=testing)
 
         # Always exit or return False if input is not valid
         if valid == False:
@@ -112,9 +112,7 @@ def get_structures(inputs,build_dir=None,clean_up=True,fail_exit=True):
     bot.debug(message %build_dir)
 
     for testing in inputs:
-        valid = validate_dataset(dataset=testing,
-                                 testing_base=build_dir,
-                                 clean_up=clean_up)
+        valid = validate_dataset(dataset=testing)
 
         # We only structure input that is valid
         if valid == False:
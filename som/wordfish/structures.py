@@ -15,6 +15,7 @@ import json
 import sys
 
 from som.utils import (
+    iter_compressed,
     untar_dir,
     unzip_dir,
     read_json
@@ -32,20 +33,22 @@ from validator import (
 )
 
 
-def structure_dataset(dataset,testing_base=None,clean_up=True):
+def structure_dataset(dataset,testing_base=None,clean_up=True,extract=True):
     '''structure_dataset is a general function to take a compressed object 
     (zip or .targz) or folder and run the correct functions to return a json
     datastructure, depending on the input types
     :param dataset: the full path to the dataset
     :param testing_base: the testing_base directory
     :param clean_up: whether to clean up the directory upon finish
+    :param extract: if False, read a compressed dataset without extracting it
     '''
     if os.path.isdir(dataset):
         structure = structure_folder(folder=dataset)
     elif re.search("[.]zip$|[.]tar[.]gz$",dataset):
         structure = structure_compressed(compressed_file=dataset,
                                          testing_base=testing_base,
-                                         clean_up=clean_up)
+                                         clean_up=clean_up,
+                                         extract=extract)
     return structure
 
 
@@ -79,7 +82,7 @@ def structure_metadata(full_path,metadata_type=None):
         return None
 
 
-def structure_compressed(compressed_file,testing_base=None,clean_up=False):
+def structure_compressed(compressed_file,testing_base=None,clean_up=False,extract=True):
     '''structure_compressed will first decompress a file to a temporary location,
     and then return the file structure in the WordFish standard. 
     :param compressed_file: the file to first extract.
@@ -87,7 +90,11 @@ def structure_compressed(compressed_file,testing_base=None,clean_up=False):
     a folder will be made in testing_base.
     :param clean_up: clean up (remove) extracted files/folders after test. Default False,
     so the user can access the extracted files.
+    :param extract: if False, don't extract anything, see structure_archive
     '''
+    if extract is False:
+        return structure_archive(compressed_file)
+
     if testing_base == None:
         testing_base = tempfile.mkdtemp()
  
@@ -119,6 +126,76 @@ def structure_compressed(compressed_file,testing_base=None,clean_up=False):
     return collections
 
 
+def structure_archive(compressed_file,image_types=None,text_types=None):
+    '''structure_archive will return the file structure in the WordFish
+    standard for a compressed file (.zip or .tar.gz) without extracting it.
+    The structure is the same as for structure_compressed, except that the
+    paths are names of members in the archive, and image and text metadata
+    is the parsed json (and not a path). Metadata json is read in memory.
+    :param compressed_file: the .zip or .tar.gz to read
+    :param image_types: the valid image extensions (see structure_images)
+    :param text_types: the valid text extensions (see structure_texts)
+    '''
+    if image_types == None:
+        image_types = ['dcm','png','jpg','jpeg','nii','nii.gz']
+    if text_types == None:
+        text_types = ['txt']
+
+    # Read all names, and parse json metadata, in one pass
+    names = []
+    metadata = dict()
+    for name,fileobj in iter_compressed(compressed_file):
+        names.append(name)
+        if name.endswith('.json'):
+            try:
+                metadata[name] = json.loads(fileobj.read().decode('utf-8'))
+            except ValueError:
+                bot.error('%s has invalid json metadata' %name)
+
+    # collection -> entity -> {"images": [...], "texts": [...]}
+    collections = dict()
+    for name in names:
+        parts = name.split('/')
+        if len(parts) != 5 or parts[2] not in ['images','text']:
+            continue
+        collection,entity,template_type,folder,filename = parts
+        ext = '.'.join(filename.split('.')[1:])
+        acceptable_types = image_types if template_type == "images" else text_types
+        if ext not in acceptable_types:
+            continue
+
+        valid = {'original': name}
+        metadata_file = "%s/%s.json" %('/'.join(parts[:4]),filename.split('.')[0])
+        if metadata_file in metadata:
+            valid['metadata'] = metadata[metadata_file]
+
+        key = 'images' if template_type == "images" else 'texts'
+        entities = collections.setdefault(collection, dict())
+        entities.setdefault(entity, dict()).setdefault(key, []).append(valid)
+
+    bot.info("collections found: %s" %len(collections))
+    structures = []
+    for collection in sorted(collections):
+        structure = {'name': collection}
+        if "%s.json" %collection in metadata:
+            structure['metadata'] = metadata["%s.json" %collection]
+
+        entities = []
+        for entity in sorted(collections[collection]):
+            entity_path = "%s/%s" %(collection,entity)
+            values = {'id': entity_path}
+            if "%s.json" %entity_path in metadata:
+                values['metadata'] = metadata["%s.json" %entity_path]
+            values.update(collections[collection][entity])
+            entities.append({"entity": values})
+
+        bot.info("adding %s valid entities to collection %s." %(len(entities),collection))
+        structure['entities'] = entities
+        structures.append({"collection": structure})
+
+    return structures
+
+
 def structure_folder(folder,relative_path=False):
     '''structure_folder will return a json data structure to describe a collection folder.
     The collection is named according to the input data file, and so if additional metadata
@@ -7,16 +7,13 @@ validators.py: validation of folders and compressed objects for wordfish standar
 '''
 
 from som.logger import bot
-import tempfile
-import shutil
 import os
 import re
 import json
 import sys
 
 from som.utils import (
-    untar_dir,
-    unzip_dir,
+    iter_compressed,
     read_json
 )
 
@@ -31,13 +28,13 @@ from validator import (
     validate
 )
 
-def validate_dataset(dataset,testing_base=None,clean_up=True):
+def validate_dataset(dataset,testing_base=None,clean_up=None):
     '''validate_dataset is a general function to take a compressed object 
     (zip or .targz) or folder and run the correct validation functions depending
     on the input type.
     :param dataset: the full path to the dataset
-    :param testing_base: the testing_base directory
-    :param clean_up: whether to clean up the directory upon finish
+    :param testing_base: deprecated, see validate_compressed
+    :param clean_up: deprecated, see validate_compressed
     '''
     if os.path.isdir(dataset):
         valid = validate_folder(folder=dataset)
@@ -241,37 +238,130 @@ def validate_template(entity_path, template_type, acceptable_types):
     return valid
 
 
-def validate_compressed(compressed_file,testing_base=None,clean_up=True):
-    '''validate_compressed will first decompress a file to a temporary location,
-    and then test if the folder is valid given the WordFish standard.
-    :param compressed_file: the file to first extract.
-    :param testing_base: If not given, a temporary location will be created. Otherwise,
-    a folder will be made in testing_base.
-    :param clean_up: clean up (remove) extracted files/folders after test. Default True
+def validate_compressed(compressed_file,testing_base=None,clean_up=None):
+    '''validate_compressed will test if a compressed file (.zip or .tar.gz) is
+    valid given the WordFish standard, walking the members of the archive
+    in place. Nothing is extracted, only json metadata is read (in memory).
+    :param compressed_file: the file to validate
+    :param testing_base: deprecated, nothing is extracted
+    :param clean_up: deprecated, nothing is extracted
     '''
-    if testing_base == None:
-        testing_base = tempfile.mkdtemp()
- 
-    valid = True
-    dest_dir = tempfile.mkdtemp(prefix="%s/" %testing_base)
-    if compressed_file.endswith('.tar.gz'):
-        test_folder = untar_dir(compressed_file,dest_dir)
- 
-    elif compressed_file.endswith('.zip'):
-        test_folder = unzip_dir(compressed_file,dest_dir)
+    if testing_base is not None or clean_up is not None:
+        bot.warning("testing_base and clean_up are deprecated, compressed files are validated without extracting them.")
 
-    else:
+    if not re.search("[.]zip$|[.]tar[.]gz$",compressed_file):
         bot.error("Invalid compressed file type: %s, exiting." %compressed_file)
         sys.exit(1)
 
-    # Each object in the folder (a collection)
-    collections = os.listdir(test_folder)
+    # Read all names, and check json metadata, in one pass
+    names = []
+    metadata = dict()
+    for name,fileobj in iter_compressed(compressed_file):
+        names.append(name)
+        if name.endswith('.json'):
+            try:
+                json.loads(fileobj.read().decode('utf-8'))
+                metadata[name] = True
+            except ValueError:
+                metadata[name] = False
+
+    # collection -> entity -> template type -> [file names]
+    collections = dict()
+    for name in names:
+        parts = name.split('/')
+        if len(parts) < 3:
+            continue
+        entities = collections.setdefault(parts[0], dict())
+        templates = entities.setdefault(parts[1], dict())
+        if len(parts) == 5:
+            templates.setdefault(parts[2], []).append(name)
+
+    valid = True
     bot.info("collections found: %s" %len(collections))
-    for collection in collections:
-        collection_path = "%s/%s" %(test_folder,collection)
-        if validate_folder(collection_path) == False:
+    for collection in sorted(collections):
+        if validate_archive_collection(collection,collections[collection],metadata) == False:
             bot.error("collection %s is invalid." %collection)
+            valid = False
+    return valid
+
+
+def validate_archive_collection(collection,entities,metadata):
+    '''validate_archive_collection is validate_folder for a collection in a
+    compressed file, see validate_compressed.
+    :param collection: the name of the collection (top level folder)
+    :param entities: a dictionary of template types and file names by entity
+    :param metadata: True (valid) or False for each json file in the archive
+    '''
+    valid = True
+    if validate_archive_metadata(collection,metadata) == False:
+        valid = False
+
+    bot.info("Found %s entities in collection." %len(entities))
+    for entity in sorted(entities):
+        entity_path = "%s/%s" %(collection,entity)
+        if validate_archive_metadata(entity_path,metadata,"entity") == False:
+            valid = False
+
+        entity_texts = validate_archive_template(entity_path=entity_path,
+                                                 names=entities[entity].get('text', []),
+                                                 template_type="text",
+                                                 acceptable_types=['txt'],
+                                                 metadata=metadata)
+        entity_images = validate_archive_template(entity_path=entity_path,
+                                                  names=entities[entity].get('images', []),
+                                                  template_type="images",
+                                                  acceptable_types=['dcm','png','jpg','jpeg','nii','nii.gz'],
+                                                  metadata=metadata)
+
+        if entity_texts == None and entity_images == None:
+            bot.error("found invalid entity: does not have images or text.")
+            valid = False
+        if entity_texts == False or entity_images == False:
+            bot.error("entity %s does not have valid images or text." %(entity))
+            valid = False
 
-    if clean_up == True:
-        shutil.rmtree(dest_dir)
+    if valid:
+        print("collection %s is valid." %collection)
     return valid
+
+
+def validate_archive_template(entity_path,names,template_type,acceptable_types,metadata):
+    '''validate_archive_template is validate_template for the file names of
+    one template type (images or text) of an entity in a compressed file.
+    Returns None if there are no valid files.
+    '''
+    entity_name = os.path.basename(entity_path)
+    valids = [name for name in names
+              if '.'.join(os.path.basename(name).split('.')[1:]) in acceptable_types]
+    if len(valids) == 0:
+        bot.info("entity %s does not have %s." %(entity_name, template_type))
+        return None
+    bot.info("entity %s has %s %s" %(entity_name, len(valids), template_type))
+
+    valid = True
+    for contender in valids:
+        if validate_archive_metadata(contender,metadata,template_type) == False:
+            bot.error("metadata %s for entity %s is invalid" %(contender,entity_name))
+            valid = False
+    return valid
+
+
+def validate_archive_metadata(name,metadata,metadata_type=None):
+    '''validate_archive_metadata is validate_metadata for a member name in
+    a compressed file: the metadata is the json file of the same name in
+    the parent folder. None is returned if there isn't one, otherwise True
+    if it is valid json.
+    '''
+    if metadata_type == None:
+        metadata_type = "collection"
+
+    base_name = os.path.basename(name).split('.')[0]
+    metadata_file = "%s.json" %'/'.join(name.split('/')[:-1] + [base_name])
+    if metadata_file not in metadata:
+        bot.info('%s %s does not have metadata file %s.json' %(metadata_type, base_name, base_name))
+        return None
+    if metadata[metadata_file] == False:
+        bot.error('%s %s has invalid json metadata %s' %(metadata_type, base_name, metadata_file))
+        return False
+    bot.info('%s %s metadata is valid' %(metadata_type, base_name))
+    return True